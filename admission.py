@@ -0,0 +1,193 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# ----------------------------
+# Priority Classes
+# ----------------------------
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is refused before it reaches the model."""
+
+    def __init__(self, status_code, reason):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+# ----------------------------
+# Request Deadlines
+# ----------------------------
+class Deadline:
+    """Absolute point in (monotonic) time after which a request is useless."""
+
+    def __init__(self, timeout_ms):
+        self.timeout_ms = timeout_ms
+        self.expires_at = time.monotonic() + timeout_ms / 1000.0
+
+    @classmethod
+    def from_value(cls, value, default_ms, max_ms):
+        """Builds a deadline from a caller-supplied value, falling back to the server default."""
+        if value is None or value == "":
+            return cls(default_ms)
+        try:
+            timeout_ms = float(value)
+        except (TypeError, ValueError):
+            raise AdmissionRejected(400, f"Invalid deadline: {value!r}")
+        if timeout_ms <= 0:
+            raise AdmissionRejected(504, "Request deadline already expired")
+        return cls(min(timeout_ms, max_ms))
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage):
+        if self.expired():
+            raise AdmissionRejected(504, f"Request deadline expired before {stage}")
+
+
+def parse_priority(value):
+    if value is None or value == "":
+        return INTERACTIVE
+    value = str(value).lower()
+    if value not in PRIORITIES:
+        raise AdmissionRejected(400, f"Unknown priority {value!r}, expected one of {PRIORITIES}")
+    return value
+
+
+# ----------------------------
+# Per-Client Concurrency Limits
+# ----------------------------
+class ClientLimiter:
+    """Caps the number of in-flight requests any single client may hold."""
+
+    def __init__(self, max_per_client):
+        self.max_per_client = max_per_client
+        self._active = {}
+
+    @asynccontextmanager
+    async def hold(self, client_id):
+        count = self._active.get(client_id, 0)
+        if count >= self.max_per_client:
+            raise AdmissionRejected(429, f"Too many concurrent requests from client {client_id}")
+        self._active[client_id] = count + 1
+        try:
+            yield
+        finally:
+            remaining = self._active[client_id] - 1
+            if remaining:
+                self._active[client_id] = remaining
+            else:
+                del self._active[client_id]
+
+
+# ----------------------------
+# Priority-Aware Inference Scheduler
+# ----------------------------
+class InferenceScheduler:
+    """
+    Hands out a fixed number of inference slots. Interactive callers are always
+    served before bulk callers, each class has a bounded queue, and a request is
+    shed up front when its deadline cannot be met given the current backlog, so
+    queueing delay stays bounded instead of growing with load.
+    """
+
+    def __init__(self, max_inflight, max_queue, ewma_alpha=0.2, initial_service_time=0.05):
+        self.max_inflight = max_inflight
+        self.max_queue = dict(max_queue)
+        self.ewma_alpha = ewma_alpha
+        self.service_time = initial_service_time
+        self._inflight = 0
+        self._waiters = {priority: deque() for priority in PRIORITIES}
+        self.shed = {priority: 0 for priority in PRIORITIES}
+
+    def _queued_ahead(self, priority):
+        if priority == INTERACTIVE:
+            return len(self._waiters[INTERACTIVE])
+        return len(self._waiters[INTERACTIVE]) + len(self._waiters[BULK])
+
+    def estimated_wait(self, priority):
+        """Rough queueing delay for a new request of this class, in seconds."""
+        if self._inflight < self.max_inflight and not any(self._waiters.values()):
+            return 0.0
+        return (self._queued_ahead(priority) / self.max_inflight + 1) * self.service_time
+
+    def _reject(self, priority, status_code, reason):
+        self.shed[priority] += 1
+        raise AdmissionRejected(status_code, reason)
+
+    async def _acquire(self, priority, deadline):
+        deadline.check("scheduling")
+        if self._inflight < self.max_inflight and not any(self._waiters.values()):
+            self._inflight += 1
+            return
+
+        if len(self._waiters[priority]) >= self.max_queue[priority]:
+            self._reject(priority, 503, f"Server overloaded ({priority} queue full)")
+        if self.estimated_wait(priority) + self.service_time > deadline.remaining():
+            self._reject(priority, 503, "Server overloaded (deadline cannot be met)")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await asyncio.wait_for(waiter, deadline.remaining())
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # The slot may have been handed over just before the timeout or cancellation.
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject(priority, 504, "Request deadline expired while queued")
+        finally:
+            if waiter in self._waiters[priority]:
+                self._waiters[priority].remove(waiter)
+
+    def _release(self):
+        for priority in PRIORITIES:
+            queue = self._waiters[priority]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # Slot ownership passes directly to the waiter.
+                    waiter.set_result(None)
+                    return
+        self._inflight -= 1
+
+    def _record(self, elapsed):
+        self.service_time = (1 - self.ewma_alpha) * self.service_time + self.ewma_alpha * elapsed
+
+    @asynccontextmanager
+    async def slot(self, priority, deadline):
+        await self._acquire(priority, deadline)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(time.perf_counter() - start)
+            self._release()
+
+    def stats(self):
+        return {
+            "inflight": self._inflight,
+            "queued": {priority: len(queue) for priority, queue in self._waiters.items()},
+            "shed": dict(self.shed),
+            "service_time_ms": round(self.service_time * 1000, 2),
+        }
+
+
+# ----------------------------
+# Image Size Checks
+# ----------------------------
+def check_image_pixels(image, max_pixels):
+    """Validates header dimensions of a lazily opened PIL image before it is decoded."""
+    width, height = image.size
+    if width * height > max_pixels:
+        raise AdmissionRejected(413, f"Image too large: {width}x{height} exceeds {max_pixels} pixels")
@@ -0,0 +1,339 @@
+"""
+How training, evaluation and server scoring scale from 1k to 1M images.
+
+    python benchmark_scaling.py --sizes 1000 10000 100000 1000000 --max-seconds 120
+
+For each size a synthetic dataset is generated (or reused) under ``--root``
+with ``synthetic_data.py``. Each stage then runs in a fresh process, so its
+memory numbers are its own:
+
+- train: one epoch of the ``model_training.ipynb`` loop (weighted cross-entropy, Adam)
+- eval:  ``evaluation.collect_logits`` + ``compute_metrics``, as ``model_testing(new).ipynb`` runs them
+- serve: ``decode_and_predict`` from ``server(new).py`` per file, ``MAX_INFLIGHT_INFERENCES`` at a time
+
+A stage stops after ``--max-seconds``, so large sizes report the steady-state
+rate over the images it reached; ``setup s`` (indexing the dataset) still
+covers every file. Memory is the stage process's RSS once the model and
+dataset index are loaded, its growth over the loop and its peak. I/O is
+reported as the share of loop time spent waiting for data (file reads,
+decoding and transforms), the host's iowait percentage and the bytes the
+process read from disk (the last two on Linux only).
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from synthetic_data import FORMATS, generate_dataset
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ("train", "eval", "serve")
+SERVER_PATH = "server(new).py"
+
+
+# ----------------------------
+# Process Measurements
+# ----------------------------
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def host_cpu_times():
+    try:
+        with open("/proc/stat") as f:
+            return [int(value) for value in f.readline().split()[1:]]
+    except OSError:
+        return None
+
+
+def read_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("read_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class StageMeter:
+    """Counts images, time spent waiting for data and resource use of one stage."""
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+        self.images = 0
+        self.data_wait = 0.0
+        self.extra = {}
+        self._start = time.perf_counter()
+        self._rss_start = rss_mb()
+        self._cpu_start = host_cpu_times()
+        self._read_start = read_bytes()
+        self._rss_setup = None
+        self._loop_start = None
+
+    def setup_done(self):
+        self._rss_setup = rss_mb()
+        self._loop_start = time.perf_counter()
+
+    def expired(self):
+        return time.perf_counter() - self._loop_start >= self.max_seconds
+
+    def timed(self, iterable):
+        """Yields from ``iterable``, charging the time blocked in ``next`` to data wait; stops on expiry."""
+        iterator = iter(iterable)
+        while not self.expired():
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.data_wait += time.perf_counter() - start
+            yield item
+
+    def result(self):
+        end = time.perf_counter()
+        loop_time = max(end - self._loop_start, 1e-9)
+        cpu_end, read_end, rss_end = host_cpu_times(), read_bytes(), rss_mb()
+        iowait = None
+        if self._cpu_start and cpu_end:
+            delta = [after - before for after, before in zip(cpu_end, self._cpu_start)]
+            iowait = 100 * delta[4] / max(sum(delta), 1)  # 5th /proc/stat column is iowait
+        return {
+            "images": self.images,
+            "images_per_s": self.images / loop_time,
+            "setup_s": self._loop_start - self._start,
+            "loop_s": loop_time,
+            "rss_start_mb": self._rss_start,
+            "rss_setup_mb": self._rss_setup,
+            "rss_end_mb": rss_end,
+            "rss_growth_mb": None if rss_end is None or self._rss_setup is None else rss_end - self._rss_setup,
+            "peak_rss_mb": peak_rss_mb(),
+            "data_wait_pct": 100 * self.data_wait / loop_time,
+            "iowait_pct": iowait,
+            "read_mb": None if read_end is None or self._read_start is None else (read_end - self._read_start) / 2**20,
+            **self.extra,
+        }
+
+
+# ----------------------------
+# Stages
+# ----------------------------
+def _build_model(model_path, device):
+    from inference import build_model, load_model
+
+    if model_path and os.path.exists(model_path):
+        return load_model(model_path, device)
+    # Weights do not affect speed; fall back to a randomly initialised network
+    return build_model().to(device).eval()
+
+
+def run_train(data_dir, args, meter):
+    import torch
+    import torch.nn as nn
+    import torch.optim as optim
+    from torch.utils.data import DataLoader
+    from torchvision import datasets
+
+    from inference import train_transform
+
+    device = torch.device(args.device)
+    # Same transforms, loss and optimizer as model_training.ipynb
+    dataset = datasets.ImageFolder(data_dir, transform=train_transform())
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+
+    model = _build_model(None, device)
+    class_counts = torch.bincount(torch.as_tensor(dataset.targets), minlength=len(dataset.classes)).float()
+    class_weights = 1.0 / class_counts.clamp(min=1)
+    class_weights = (class_weights / class_weights.sum()).to(device)
+    criterion = nn.CrossEntropyLoss(weight=class_weights)
+    optimizer = optim.Adam(model.parameters(), lr=0.0001)
+    model.train()
+    meter.setup_done()
+
+    for inputs, labels in meter.timed(loader):
+        inputs, labels = inputs.to(device), labels.to(device)
+        optimizer.zero_grad()
+        loss = criterion(model(inputs), labels)
+        loss.backward()
+        optimizer.step()
+        meter.images += len(inputs)
+
+
+class _CappedLoader:
+    """Lets ``collect_logits`` run unchanged while the meter stops it at the time limit."""
+
+    def __init__(self, loader, meter):
+        self.dataset = loader.dataset
+        self._loader = loader
+        self._meter = meter
+
+    def __iter__(self):
+        for images, targets in self._meter.timed(self._loader):
+            self._meter.images += len(images)
+            yield images, targets
+
+
+def run_eval(data_dir, args, meter):
+    import torch
+    from torch.utils.data import DataLoader
+    from torchvision import datasets
+
+    from evaluation import collect_logits, compute_metrics
+    from inference import eval_transform
+
+    device = torch.device(args.device)
+    dataset = datasets.ImageFolder(data_dir, transform=eval_transform())
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    model = _build_model(args.model, device)
+    meter.setup_done()
+
+    logits, labels = collect_logits(model, _CappedLoader(loader, meter), device)
+    start = time.perf_counter()
+    metrics = compute_metrics(logits[:meter.images], labels[:meter.images])
+    meter.extra["metrics_s"] = time.perf_counter() - start
+    meter.extra["accuracy"] = metrics["accuracy"]
+
+
+def load_server(path=SERVER_PATH):
+    """Imports ``server(new).py`` (not a valid module name) to call its scoring functions directly."""
+    spec = importlib.util.spec_from_file_location("server_new", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_serve(data_dir, args, meter):
+    from torchvision import datasets
+
+    from ingest import sniff_image
+
+    server = load_server()
+    server.logger.setLevel(logging.ERROR)  # one "no face" warning per synthetic image otherwise
+    # Score only: synthetic images must not end up in the real face index or prediction log
+    if server.prediction_log is not None:
+        server.prediction_log.close()
+    server.face_index = None
+    server.prediction_log = None
+    # Only the file list; the server decodes each upload itself
+    paths = [path for path, _ in datasets.ImageFolder(data_dir).samples]
+    meter.setup_done()
+
+    def score(path):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            data = f.read()
+        read_s = time.perf_counter() - start
+        image = sniff_image(data, server.MAX_DECODED_PIXELS)
+        server.decode_and_predict(image, server.TTA_MODE, hashlib.sha256(data).hexdigest())
+        return read_s, time.perf_counter() - start
+
+    # Requests bypass the HTTP layer and admission queue but keep the server's concurrency
+    concurrency = server.MAX_INFLIGHT_INFERENCES
+    latencies, read_time = [], 0.0
+    with ThreadPoolExecutor(concurrency) as pool:
+        for start in range(0, len(paths), 16 * concurrency):
+            if meter.expired():
+                break
+            for read_s, total_s in pool.map(score, paths[start:start + 16 * concurrency]):
+                read_time += read_s
+                latencies.append(total_s * 1000)
+    meter.images = len(latencies)
+    # Reads happen on the worker threads; charge their share of the wall time
+    meter.data_wait = read_time / concurrency
+    if latencies:
+        meter.extra["p50_ms"] = float(np.percentile(latencies, 50))
+        meter.extra["p95_ms"] = float(np.percentile(latencies, 95))
+
+
+STAGE_RUNNERS = {"train": run_train, "eval": run_eval, "serve": run_serve}
+
+
+def run_stage(stage, data_dir, args):
+    """Runs in a fresh process, so peak RSS belongs to this stage alone."""
+    meter = StageMeter(args.max_seconds)
+    STAGE_RUNNERS[stage](data_dir, args, meter)
+    return meter.result()
+
+
+# ----------------------------
+# Report
+# ----------------------------
+def _fmt(value, spec):
+    return f"{value:{spec}}" if value is not None else f"{'-':>{spec.split('.')[0]}}"
+
+
+def print_row(size, stage, r):
+    print(f"{size:>9} {stage:<6}{r['images']:>9}{r['images_per_s']:>9.1f}{r['setup_s']:>9.1f}"
+          f"{_fmt(r['rss_setup_mb'], '9.0f')}{_fmt(r['rss_growth_mb'], '+9.0f')}{_fmt(r['peak_rss_mb'], '9.0f')}"
+          f"{r['data_wait_pct']:>9.1f}{_fmt(r['iowait_pct'], '9.1f')}{_fmt(r['read_mb'], '9.1f')}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--source", default="drug_users_test")
+    parser.add_argument("--root", default="synthetic", help="where the generated datasets are kept")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[224])
+    parser.add_argument("--formats", nargs="+", default=["png"], choices=list(FORMATS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", default="best_model.pth", help="for eval; serve always loads the server's model")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader workers for train and eval")
+    parser.add_argument("--max-seconds", type=float, default=120.0, help="time limit per stage and size")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default="scaling_results.json")
+    args = parser.parse_args()
+
+    if "serve" in args.stages and not os.path.exists("best_model.pth"):
+        print("⚠️ best_model.pth not found; skipping the serve stage")
+        args.stages = [stage for stage in args.stages if stage != "serve"]
+
+    results = []
+    for size in args.sizes:
+        data_dir = os.path.join(args.root, f"n{size}")
+        print(f"\nDataset: {size} images in {data_dir}")
+        # The datasets under --root are the benchmark's own; regenerate when the settings change
+        manifest = generate_dataset(args.source, data_dir, size, args.resolutions, args.formats, args.seed,
+                                    overwrite=True)
+        print(f"{manifest['bytes'] / 2**30:.2f} GiB on disk\n")
+        print(f"{'size':>9} {'stage':<6}{'images':>9}{'img/s':>9}{'setup s':>9}{'rss MB':>9}{'growth':>9}"
+              f"{'peak MB':>9}{'wait %':>9}{'iowait %':>9}{'read MB':>9}")
+        for stage in args.stages:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                result = pool.apply(run_stage, (stage, data_dir, args))
+            print_row(size, stage, result)
+            results.append({"size": size, "stage": stage, **result})
+
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(f"\n✅ Results saved as {args.output}")
+
+
+if __name__ == "__main__":
+    main()
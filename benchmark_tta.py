@@ -0,0 +1,74 @@
+"""
+Measures what each test-time augmentation mode costs and buys on a test set.
+
+    python benchmark_tta.py --data-dir drug_users_test --model best_model.pth
+
+For every mode all views of a batch go through the model in a single forward
+pass; the table reports accuracy, per-image latency and both relative to "none".
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from torchvision import datasets
+
+from inference import TTA_MODES, eval_transform, load_model, num_views, predict_proba
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run_mode(model, data_dir, mode, batch_size, device):
+    dataset = datasets.ImageFolder(root=data_dir, transform=eval_transform(mode))
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+    labels = torch.as_tensor(dataset.targets)
+    preds = torch.empty(len(dataset), dtype=torch.long)
+
+    # Warm-up so one-off allocations are not counted
+    images, _ = next(iter(loader))
+    predict_proba(model, images.to(device), mode)
+
+    model_time = 0.0
+    offset = 0
+    for images, _ in loader:
+        images = images.to(device)
+        sync(device)
+        start = time.perf_counter()
+        probs = predict_proba(model, images, mode)
+        sync(device)
+        model_time += time.perf_counter() - start
+
+        preds[offset:offset + len(images)] = probs.argmax(dim=1).cpu()
+        offset += len(images)
+
+    accuracy = (preds == labels).float().mean().item()
+    return accuracy, model_time / len(dataset) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", default="drug_users_test")
+    parser.add_argument("--model", default="best_model.pth")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--modes", nargs="+", default=list(TTA_MODES), choices=list(TTA_MODES))
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = load_model(args.model, device)
+
+    results = {mode: run_mode(model, args.data_dir, mode, args.batch_size, device) for mode in args.modes}
+    base_acc, base_ms = results.get("none", next(iter(results.values())))
+
+    print(f"\n{'mode':<16}{'views':>6}{'accuracy':>10}{'ms/img':>10}{'latency x':>11}{'acc delta':>11}")
+    for mode, (acc, ms) in results.items():
+        print(f"{mode:<16}{num_views(mode):>6}{acc * 100:>9.2f}%{ms:>10.2f}"
+              f"{ms / base_ms:>10.2f}x{(acc - base_acc) * 100:>+10.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,8 @@ import flet as ft
 import requests
 import threading
 from PIL import Image
-import cv2
 import numpy as np
+from inference import FaceDetector
 
 SERVER_URL = "http://127.0.0.1:8000/upload"
 
@@ -20,31 +20,20 @@ def main(page: ft.Page):
     file_picker = ft.FilePicker()
     page.overlay.append(file_picker)
 
-    # Load OpenCV Haar Cascade for face detection
+    # Same Haar cascade and parameters as the server, so a face accepted here is accepted there
+    face_detector = FaceDetector()
     try:
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-    except:
-        face_cascade = None
+        face_detector.cascade
+    except Exception:
+        face_detector = None
 
     def detect_face_in_image(image_path):
         """Detect if the image contains a human face using OpenCV"""
-        if face_cascade is None:
+        if face_detector is None:
             return True  # Skip validation if cascade couldn't be loaded
         
         try:
-            image = cv2.imread(image_path)
-            if image is None:
-                return False
-                
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            faces = face_cascade.detectMultiScale(
-                gray, 
-                scaleFactor=1.1, 
-                minNeighbors=5, 
-                minSize=(60, 60)
-            )
-            
-            return len(faces) > 0
+            return face_detector.has_face_in_file(image_path)
             
         except Exception as e:
             print(f"Face detection error: {e}")
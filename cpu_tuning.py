@@ -0,0 +1,272 @@
+"""
+CPU threading auto-tuner for the inference process.
+
+    python cpu_tuning.py --workers 1 --concurrency 2 --output thread_profile.json
+
+Sweeps PyTorch intra-op and inter-op threads, OpenCV threads, batch size and
+channels_last for efficientnet_b0, with ``concurrency`` requests in flight
+like the server runs them, and writes the fastest configuration that meets
+the latency budget at the server's batch size (one request's TTA views).
+``server(new).py`` applies the thread counts and channels_last at startup
+and warns when threads x concurrent inferences x workers exceed the cores
+the process may run on. Other batch sizes are only kept in ``sweep`` for
+offline batch jobs.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PROFILE_VERSION = 1
+
+
+# ----------------------------
+# Core Accounting
+# ----------------------------
+def available_cores():
+    """Cores this process may run on (respects taskset/cgroup affinity, unlike os.cpu_count)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_count():
+    """uvicorn/gunicorn worker processes, as far as the environment tells us."""
+    try:
+        return max(int(os.environ.get("WEB_CONCURRENCY", "1")), 1)
+    except ValueError:
+        return 1
+
+
+def check_oversubscription(concurrent_inferences, workers=None):
+    """Returns a warning message if the configured threads exceed the available cores, else None."""
+    import cv2
+    import torch
+
+    workers = workers or worker_count()
+    cores = available_cores()
+    torch_threads = torch.get_num_threads() * concurrent_inferences * workers
+    cv2_threads = max(cv2.getNumThreads(), 1) * workers
+    if torch_threads > cores or cv2_threads > cores:
+        return (f"CPU oversubscription: {workers} worker(s) x {concurrent_inferences} concurrent inference(s) x "
+                f"{torch.get_num_threads()} torch thread(s) = {torch_threads} threads, OpenCV {cv2_threads} threads, "
+                f"on {cores} available cores. Run cpu_tuning.py or lower the thread counts.")
+    return None
+
+
+class LoadMonitor:
+    """Rate-limited runtime check of the 1-minute load average against the available cores."""
+
+    def __init__(self, interval=60.0, factor=1.5):
+        self.interval = interval
+        self.factor = factor
+        self._last_check = 0.0
+
+    def maybe_warn(self):
+        now = time.monotonic()
+        if now - self._last_check < self.interval or not hasattr(os, "getloadavg"):
+            return
+        self._last_check = now
+        load = os.getloadavg()[0]
+        cores = available_cores()
+        if load > self.factor * cores:
+            logger.warning(f"Load average {load:.1f} exceeds {cores} available cores; "
+                           f"inference threads are likely oversubscribed")
+
+
+# ----------------------------
+# Applying a Profile
+# ----------------------------
+def load_profile(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_profile(profile, model):
+    """Applies thread counts and memory format; returns the (possibly converted) model."""
+    import cv2
+    import torch
+
+    try:
+        torch.set_num_interop_threads(profile["torch_interop_threads"])
+    except RuntimeError:
+        # Only possible before any inter-op parallel work has started
+        logger.warning("Could not set inter-op threads: parallel work already started in this process")
+    torch.set_num_threads(profile["torch_num_threads"])
+    cv2.setNumThreads(profile["cv2_num_threads"])
+    if profile.get("channels_last"):
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+# ----------------------------
+# Sweep
+# ----------------------------
+def _build_model(model_path):
+    import torch
+
+    from inference import build_model, load_model
+
+    if model_path and os.path.exists(model_path):
+        return load_model(model_path, torch.device("cpu"))
+    # Weights do not affect speed; fall back to a randomly initialised network
+    return build_model().eval()
+
+
+def _time_model(model, batch_size, channels_last, concurrency, min_seconds):
+    import torch
+
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    # Module.to converts in place, so switch explicitly in both directions
+    model = model.to(memory_format=memory_format)
+    batch = torch.randn(batch_size, 3, 224, 224).contiguous(memory_format=memory_format)
+
+    def forward():
+        start = time.perf_counter()
+        with torch.no_grad():
+            model(batch)
+        return time.perf_counter() - start
+
+    for _ in range(2):
+        forward()
+
+    latencies = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        while time.perf_counter() - start < min_seconds:
+            latencies.extend(pool.map(lambda _: forward(), range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        "throughput": len(latencies) * batch_size / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def _sweep_interop(args):
+    """Runs in a fresh process: inter-op threads can only be set once per process."""
+    interop, thread_options, batch_sizes, concurrency, model_path, min_seconds = args
+    import torch
+
+    torch.set_num_interop_threads(interop)
+    model = _build_model(model_path)
+    results = []
+    for threads in thread_options:
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            for channels_last in (False, True):
+                stats = _time_model(model, batch_size, channels_last, concurrency, min_seconds)
+                results.append(dict(torch_num_threads=threads, torch_interop_threads=interop,
+                                    batch_size=batch_size, channels_last=channels_last, **stats))
+                print(f"  threads={threads:<3} interop={interop:<2} batch={batch_size:<3} "
+                      f"channels_last={channels_last!s:<5} {stats['throughput']:8.1f} img/s  "
+                      f"p95 {stats['p95_ms']:7.1f} ms", flush=True)
+    return results
+
+
+def run_sweep(jobs):
+    """Runs each ``_sweep_interop`` job in its own spawned process and returns all results."""
+    results = []
+    # maxtasksperchild=1: a reused worker could not set its inter-op threads again
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for chunk in pool.imap(_sweep_interop, jobs):
+            results.extend(chunk)
+    return results
+
+
+def _sweep_cv2(thread_options, image_path, repeats=20):
+    import cv2
+
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    gray = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2GRAY)
+    timings = {}
+    for threads in thread_options:
+        cv2.setNumThreads(threads)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
+        timings[threads] = (time.perf_counter() - start) / repeats * 1000
+        print(f"  cv2 threads={threads:<3} detectMultiScale {timings[threads]:7.2f} ms", flush=True)
+    return min(timings, key=timings.get), timings
+
+
+def _powers_of_two(limit):
+    options, n = [], 1
+    while n <= limit:
+        options.append(n)
+        n *= 2
+    if options[-1] != limit:
+        options.append(limit)
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="best_model.pth")
+    parser.add_argument("--workers", type=int, default=worker_count(), help="server worker processes on this host")
+    parser.add_argument("--concurrency", type=int, default=2, help="inferences in flight per worker (MAX_INFLIGHT_INFERENCES)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--serve-batch-size", type=int, default=1,
+                        help="images per forward pass in the server: the TTA views of one request (10 for five_crop_flip)")
+    parser.add_argument("--max-latency-ms", type=float, default=250.0, help="p95 budget per forward pass")
+    parser.add_argument("--seconds", type=float, default=2.0, help="measurement time per configuration")
+    parser.add_argument("--sample-image", default="drug_users_test/drug_user/1.png")
+    parser.add_argument("--output", default="thread_profile.json")
+    args = parser.parse_args()
+
+    cores = available_cores()
+    # Never offer more threads than a worker's share of the cores across its concurrent inferences
+    per_inference = max(cores // (args.workers * args.concurrency), 1)
+    thread_options = _powers_of_two(per_inference)
+    interop_options = sorted({1, min(2, per_inference)})
+    print(f"{cores} cores, {args.workers} worker(s) x {args.concurrency} concurrent inference(s): "
+          f"sweeping {thread_options} intra-op threads")
+
+    batch_sizes = sorted(set(args.batch_sizes) | {args.serve_batch_size})
+    jobs = [(interop, thread_options, batch_sizes, args.concurrency, args.model, args.seconds)
+            for interop in interop_options]
+    results = run_sweep(jobs)
+
+    # The server runs one request per forward pass, so only the serving batch size can be applied
+    serving = [r for r in results if r["batch_size"] == args.serve_batch_size]
+    within_budget = [r for r in serving if r["p95_ms"] <= args.max_latency_ms] or serving
+    best = max(within_budget, key=lambda r: r["throughput"])
+
+    cv2_threads = 1
+    if os.path.exists(args.sample_image):
+        cv2_threads, _ = _sweep_cv2(_powers_of_two(max(cores // args.workers, 1)), args.sample_image)
+
+    profile = {
+        "version": PROFILE_VERSION,
+        "cores": cores,
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "torch_num_threads": best["torch_num_threads"],
+        "torch_interop_threads": best["torch_interop_threads"],
+        "cv2_num_threads": cv2_threads,
+        "channels_last": best["channels_last"],
+        "measured": dict(batch_size=best["batch_size"],
+                         **{k: round(best[k], 2) for k in ("throughput", "p50_ms", "p95_ms")}),
+        "sweep": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+
+    print(f"\nBest: {best['torch_num_threads']} threads, interop {best['torch_interop_threads']}, "
+          f"cv2 {cv2_threads}, channels_last={best['channels_last']} at batch {best['batch_size']} "
+          f"-> {best['throughput']:.1f} img/s, p95 {best['p95_ms']:.1f} ms")
+    print(f"✅ Profile saved as {args.output}")
+
+
+if __name__ == "__main__":
+    main()
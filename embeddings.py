@@ -0,0 +1,195 @@
+"""
+Compact on-disk index of face embeddings from the EfficientNet backbone.
+
+The 1280-d pooled feature that feeds ``model.classifier`` is produced in the
+same forward pass as the logits (``inference.predict_with_embeddings``).
+``VectorIndex`` keeps L2-normalised float16 vectors in a memory-mapped file,
+so cosine top-k over hundreds of thousands of faces is a chunked matrix
+product that never loads the whole index. An index belongs to one checkpoint,
+and every stored verdict records the decision rule (TTA mode, temperature,
+threshold) it was made with, so it is only reused under the same rule.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+from inference import EMBEDDING_DIM, LABELS
+
+SEARCH_CHUNK_ROWS = 65536
+FLUSH_EVERY = 64
+
+
+# ----------------------------
+# Normalisation
+# ----------------------------
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# ----------------------------
+# Memory-Mapped Vector Index
+# ----------------------------
+class VectorIndex:
+    """
+    Append-only cosine index stored in ``directory``:
+
+    - ``vectors.f16``: (capacity, dim) float16, L2-normalised
+    - ``labels.i8`` / ``confidence.f32`` / ``keys.s64``: verdict and content hash per row
+    - ``rules.s64``: the decision rule each verdict was made with (``Pipeline.decision_key``)
+    - ``index.json``: dim, count, capacity and the checksum of the model that made the embeddings
+    """
+
+    def __init__(self, directory, model_checksum=None, dim=EMBEDDING_DIM, initial_capacity=1024):
+        self.directory = directory
+        self.model_checksum = model_checksum
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._pending = 0
+        os.makedirs(directory, exist_ok=True)
+
+        header_path = os.path.join(directory, "index.json")
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+            if header["dim"] != dim:
+                raise ValueError(f"Index at {directory} has dim {header['dim']}, expected {dim}")
+            if header.get("model_checksum") != model_checksum:
+                # Embeddings of another checkpoint are not comparable with this one's
+                raise ValueError(f"Index at {directory} was built with another model checkpoint")
+            self.count = header["count"]
+            self._open(header["capacity"], "r+")
+        else:
+            self.count = 0
+            self._open(initial_capacity, "w+")
+            self.flush()
+
+        self._rows_by_key = {(key.decode(), rule.decode()): row
+                             for row, (key, rule) in enumerate(zip(self._keys[:self.count], self._rules[:self.count]))
+                             if key}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open(self, capacity, mode):
+        self.capacity = capacity
+        self._vectors = np.memmap(self._path("vectors.f16"), dtype=np.float16, mode=mode, shape=(capacity, self.dim))
+        self._labels = np.memmap(self._path("labels.i8"), dtype=np.int8, mode=mode, shape=(capacity,))
+        self._confidence = np.memmap(self._path("confidence.f32"), dtype=np.float32, mode=mode, shape=(capacity,))
+        self._keys = np.memmap(self._path("keys.s64"), dtype="S64", mode=mode, shape=(capacity,))
+        self._rules = np.memmap(self._path("rules.s64"), dtype="S64", mode=mode, shape=(capacity,))
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        self._flush_arrays()
+        for name, itemsize in (("vectors.f16", 2 * self.dim), ("labels.i8", 1), ("confidence.f32", 4), ("keys.s64", 64),
+                               ("rules.s64", 64)):
+            with open(self._path(name), "r+b") as f:
+                f.truncate(capacity * itemsize)
+        self._open(capacity, "r+")
+
+    def _flush_arrays(self):
+        for array in (self._vectors, self._labels, self._confidence, self._keys, self._rules):
+            array.flush()
+
+    def flush(self):
+        self._flush_arrays()
+        with open(self._path("index.json"), "w") as f:
+            json.dump({"dim": self.dim, "count": self.count, "capacity": self.capacity,
+                       "model_checksum": self.model_checksum}, f)
+        self._pending = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, vectors, labels, confidences, keys, rules):
+        """Appends a batch of embeddings with their verdicts and decision rules; returns the new row ids."""
+        vectors = normalize(vectors)
+        n = len(vectors)
+        with self._lock:
+            if self.count + n > self.capacity:
+                self._grow(self.count + n)
+            rows = np.arange(self.count, self.count + n)
+            self._vectors[rows] = vectors.astype(np.float16)
+            self._labels[rows] = labels
+            self._confidence[rows] = confidences
+            self._keys[rows] = [key.encode() for key in keys]
+            self._rules[rows] = [rule.encode() for rule in rules]
+            for row, key, rule in zip(rows, keys, rules):
+                if key:
+                    self._rows_by_key[(key, rule)] = int(row)
+            self.count += n
+            self._pending += n
+            if self._pending >= FLUSH_EVERY:
+                self.flush()
+        return rows
+
+    def lookup_key(self, key, rule):
+        """Exact content-hash match whose verdict was made under ``rule``, or None."""
+        row = self._rows_by_key.get((key, rule))
+        return None if row is None else self.entry(row)
+
+    def entry(self, row, similarity=None):
+        item = {
+            "key": self._keys[row].decode(),
+            "label": LABELS[self._labels[row]],
+            "confidence": float(self._confidence[row]),
+            "rule": self._rules[row].decode(),
+        }
+        if similarity is not None:
+            item["similarity"] = float(similarity)
+        return item
+
+    def search(self, queries, k=5, rule=None):
+        """
+        Batched cosine top-k. Returns (scores, rows), both (Q, k'), with
+        k' = min(k, len(self)) and rows sorted by decreasing similarity.
+        The float16 rows are multiplied in place, chunk by chunk, without
+        an up-front float32 copy of the index. With ``rule``, rows made under
+        another decision rule score -inf.
+        """
+        queries = torch.from_numpy(normalize(queries)).half()
+        with self._lock:
+            count, vectors, rules = self.count, self._vectors, self._rules
+        k = min(k, count)
+        best_scores = torch.empty((len(queries), 0))
+        best_rows = torch.empty((len(queries), 0), dtype=torch.long)
+
+        for start in range(0, count, SEARCH_CHUNK_ROWS):
+            stop = min(start + SEARCH_CHUNK_ROWS, count)
+            chunk = torch.from_numpy(np.asarray(vectors[start:stop]))
+            scores = (queries @ chunk.T).float()                                # (Q, chunk)
+            if rule is not None:
+                other_rule = torch.from_numpy(np.asarray(rules[start:stop]) != rule.encode())
+                scores[:, other_rule] = float("-inf")
+            top = torch.topk(scores, min(k, stop - start), dim=1)
+            best_scores = torch.cat([best_scores, top.values], dim=1)
+            best_rows = torch.cat([best_rows, top.indices + start], dim=1)
+            if best_scores.shape[1] > k:
+                best_scores, keep = torch.topk(best_scores, k, dim=1)
+                best_rows = torch.gather(best_rows, 1, keep)
+
+        order = torch.argsort(best_scores, dim=1, descending=True)
+        return torch.gather(best_scores, 1, order).numpy(), torch.gather(best_rows, 1, order).numpy()
+
+    def similar(self, query, k=5, rule=None):
+        scores, rows = self.search(query, k, rule)
+        return [self.entry(row, score) for score, row in zip(scores[0], rows[0]) if np.isfinite(score)]
+
+    def nearest_duplicate(self, query, min_similarity, rule):
+        """
+        The closest entry made under ``rule`` if its cosine similarity is at
+        least ``min_similarity``, else None.
+        """
+        matches = self.similar(query, k=1, rule=rule)
+        if matches and matches[0]["similarity"] >= min_similarity:
+            return matches[0]
+        return None
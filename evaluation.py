@@ -0,0 +1,226 @@
+"""
+Vectorized evaluation and calibration for the drug-user classifier.
+
+    python evaluation.py --data-dir drug_users_test --model best_model.pth --write-calibration calibration.json
+
+Logits for a test set are computed once into preallocated tensors and cached
+on disk, keyed by the checkpoint checksum, so trying another threshold,
+temperature or metric never re-runs the model. All metrics are computed from
+the cached logits with NumPy in a single pass.
+"""
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision import datasets
+
+from inference import TTA_MODES, eval_transform, load_model, model_checksum, predict_logits, save_calibration
+
+# ----------------------------
+# Settings
+# ----------------------------
+CLASS_NAMES = ["Drug User", "Not Drug User"]
+NUM_CLASSES = len(CLASS_NAMES)
+POSITIVE_CLASS = 0                  # ImageFolder order: drug_user, not_user
+CACHE_DIR = ".eval_cache"
+ECE_BINS = 15
+TEMPERATURE_GRID = np.exp(np.linspace(np.log(0.05), np.log(10.0), 200))
+
+
+# ----------------------------
+# Logit Collection and Caching
+# ----------------------------
+def collect_logits(model, dataloader, device, tta_mode="none"):
+    """Runs the model over a dataloader and returns (logits, labels) as NumPy arrays."""
+    n = len(dataloader.dataset)
+    logits = torch.empty((n, NUM_CLASSES), dtype=torch.float32)
+    labels = torch.empty(n, dtype=torch.long)
+
+    offset = 0
+    for images, targets in dataloader:
+        batch = len(images)
+        logits[offset:offset + batch] = predict_logits(model, images.to(device), tta_mode).cpu()
+        labels[offset:offset + batch] = targets
+        offset += batch
+    return logits.numpy(), labels.numpy()
+
+
+def cache_key(checksum, dataset, tta_mode):
+    """Changes whenever the weights, the TTA mode or any image file changes."""
+    digest = hashlib.sha256(f"{checksum}|{tta_mode}".encode())
+    for path, label in dataset.samples:
+        stat = os.stat(path)
+        digest.update(f"|{path}|{label}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:32]
+
+
+def cached_logits(model, checksum, dataloader, device, tta_mode="none", cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, cache_key(checksum, dataloader.dataset, tta_mode) + ".npz")
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached["logits"], cached["labels"]
+
+    logits, labels = collect_logits(model, dataloader, device, tta_mode)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, logits=logits, labels=labels)
+    return logits, labels
+
+
+# ----------------------------
+# Vectorized Metrics
+# ----------------------------
+def softmax(logits, temperature=1.0):
+    scaled = logits / temperature
+    scaled = scaled - scaled.max(axis=-1, keepdims=True)
+    exp = np.exp(scaled)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def fit_temperature(logits, labels, grid=TEMPERATURE_GRID):
+    """Temperature minimising the NLL, evaluated for every grid value at once."""
+    scaled = logits[None, :, :] / grid[:, None, None]                   # (T, N, C)
+    peak = scaled.max(axis=-1, keepdims=True)
+    log_norm = np.log(np.exp(scaled - peak).sum(axis=-1)) + peak[..., 0]
+    true_logit = np.take_along_axis(scaled, labels[None, :, None], axis=-1)[..., 0]
+    nll = (log_norm - true_logit).mean(axis=1)
+    return float(grid[np.argmin(nll)])
+
+
+def binary_curves(scores, positives):
+    """True/false positive counts at every distinct score threshold (descending)."""
+    order = np.argsort(-scores, kind="mergesort")
+    scores = scores[order]
+    positives = positives[order]
+    last_of_run = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    tps = np.cumsum(positives)[last_of_run]
+    fps = last_of_run + 1 - tps
+    return tps, fps, scores[last_of_run]
+
+
+def confusion_matrix(labels, preds, num_classes=NUM_CLASSES):
+    return np.bincount(labels * num_classes + preds, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def expected_calibration_error(probs, labels, n_bins=ECE_BINS):
+    confidence = probs.max(axis=1)
+    correct = (probs.argmax(axis=1) == labels).astype(np.float64)
+    bins = np.minimum((confidence * n_bins).astype(np.int64), n_bins - 1)
+    bin_conf = np.bincount(bins, weights=confidence, minlength=n_bins)
+    bin_acc = np.bincount(bins, weights=correct, minlength=n_bins)
+    return float(np.abs(bin_acc - bin_conf).sum() / len(labels))
+
+
+def compute_metrics(logits, labels, temperature=None, threshold=None):
+    """
+    Fits (or applies) a temperature and a decision threshold on the positive
+    class probability, and returns the confusion matrix, ROC/PR curves, AUCs
+    and ECE for those settings.
+    """
+    if temperature is None:
+        temperature = fit_temperature(logits, labels)
+    probs = softmax(logits, temperature)
+    scores = probs[:, POSITIVE_CLASS]
+    positives = (labels == POSITIVE_CLASS).astype(np.int64)
+    n_pos = positives.sum()
+    n_neg = len(labels) - n_pos
+
+    tps, fps, thresholds = binary_curves(scores, positives)
+    tpr = np.r_[0.0, tps / max(n_pos, 1)]
+    fpr = np.r_[0.0, fps / max(n_neg, 1)]
+    precision_curve = tps / (tps + fps)
+    recall_curve = tps / max(n_pos, 1)
+    f1_curve = 2 * tps / (2 * tps + fps + (n_pos - tps))
+
+    if threshold is None:
+        threshold = float(thresholds[np.argmax(f1_curve)])
+
+    preds = np.where(scores >= threshold, POSITIVE_CLASS, 1 - POSITIVE_CLASS)
+    cm = confusion_matrix(labels, preds)
+    tp = cm[POSITIVE_CLASS, POSITIVE_CLASS]
+    fp = cm[:, POSITIVE_CLASS].sum() - tp
+    fn = cm[POSITIVE_CLASS].sum() - tp
+
+    return {
+        "temperature": temperature,
+        "threshold": threshold,
+        "accuracy": float(np.trace(cm) / len(labels)),
+        "precision": float(tp / max(tp + fp, 1)),
+        "recall": float(tp / max(tp + fn, 1)),
+        "f1": float(2 * tp / max(2 * tp + fp + fn, 1)),
+        "confusion_matrix": cm,
+        "roc": {"fpr": fpr, "tpr": tpr, "thresholds": thresholds},
+        "roc_auc": float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)),
+        "pr": {"precision": precision_curve, "recall": recall_curve, "thresholds": thresholds},
+        "average_precision": float(np.sum(np.diff(np.r_[0.0, recall_curve]) * precision_curve)),
+        "ece": expected_calibration_error(probs, labels),
+        "ece_uncalibrated": expected_calibration_error(softmax(logits), labels),
+    }
+
+
+def print_metrics(metrics):
+    print("\n📊 Performance Metrics:")
+    print(f"   ➤ Accuracy : {metrics['accuracy'] * 100:.2f}%")
+    print(f"   ➤ Precision: {metrics['precision'] * 100:.2f}%")
+    print(f"   ➤ Recall   : {metrics['recall'] * 100:.2f}%")
+    print(f"   ➤ F1-Score : {metrics['f1'] * 100:.2f}%")
+    print(f"   ➤ ROC AUC  : {metrics['roc_auc']:.4f}")
+    print(f"   ➤ AP       : {metrics['average_precision']:.4f}")
+    print(f"   ➤ ECE      : {metrics['ece']:.4f} (uncalibrated {metrics['ece_uncalibrated']:.4f})")
+    print(f"   ➤ Threshold: {metrics['threshold']:.4f} on P({CLASS_NAMES[POSITIVE_CLASS]}), "
+          f"temperature {metrics['temperature']:.3f}")
+
+
+def save_confusion_matrix(cm, path="confusion_matrix.png"):
+    """Writes the confusion matrix plot to disk without opening a window."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    fig = plt.figure(figsize=(6, 5))
+    sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', xticklabels=CLASS_NAMES, yticklabels=CLASS_NAMES)
+    plt.xlabel('Predicted Label')
+    plt.ylabel('True Label')
+    plt.title('Confusion Matrix')
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", default="drug_users_test")
+    parser.add_argument("--model", default="best_model.pth")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--tta", default="none", choices=list(TTA_MODES))
+    parser.add_argument("--temperature", type=float, help="use this temperature instead of fitting one")
+    parser.add_argument("--threshold", type=float, help="use this threshold instead of fitting one")
+    parser.add_argument("--write-calibration", metavar="PATH", help="save the fitted temperature/threshold for the server")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    checksum = model_checksum(args.model)
+    dataset = datasets.ImageFolder(root=args.data_dir, transform=eval_transform(args.tta))
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+
+    key = cache_key(checksum, dataset, args.tta)
+    if os.path.exists(os.path.join(CACHE_DIR, key + ".npz")):
+        model = None  # cached logits: the model is not needed
+    else:
+        model = load_model(args.model, torch.device(args.device))
+    logits, labels = cached_logits(model, checksum, dataloader, args.device, args.tta)
+
+    metrics = compute_metrics(logits, labels, args.temperature, args.threshold)
+    print_metrics(metrics)
+    save_confusion_matrix(metrics["confusion_matrix"])
+    print("✅ Confusion matrix saved as confusion_matrix.png")
+
+    if args.write_calibration:
+        save_calibration(args.write_calibration, metrics, checksum, args.tta)
+        print(f"✅ Calibration saved as {args.write_calibration}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Incremental fine-tuning on newly reviewed images, without a full retrain.
+
+    python incremental_training.py --data-dir data/drug_users_train --base best_model.pth \
+        --val-dir data/drug_users_test --output best_model_incremental.pth --write-calibration calibration.json
+
+Everything before the last ``--trainable-blocks`` EfficientNet stages is
+frozen, so its output for an image never changes: it is computed once and
+kept in ``--cache-dir``. Each run trains only the remaining stages and the
+classifier, on the images the base checkpoint has not been trained on plus
+a random replay sample of the ones it has, so earlier data is not forgotten.
+Class weights come from the label counts of that training set. Only images
+without cached features go through the frozen backbone, so a run takes
+minutes where a full ``model_training.ipynb`` run takes hours.
+
+Which images a checkpoint was trained on is recorded next to it in
+``<checkpoint>.seen.txt``. A base checkpoint without one (for example the
+notebook's ``best_model.pth``) treats every image as new on the first run.
+"""
+import argparse
+import copy
+import glob
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader, Subset
+from torchvision import datasets
+
+from evaluation import NUM_CLASSES, compute_metrics, print_metrics
+from inference import eval_transform, load_model, model_checksum, save_calibration
+
+FEATURE_VERSION = 1   # bump when eval_transform("none") changes
+CHUNK_ROWS = 4096
+
+
+# ----------------------------
+# Frozen Backbone / Trainable Head
+# ----------------------------
+def split_model(model, trainable_blocks):
+    """
+    Returns (backbone, head) sharing modules with ``model``: backbone(x) is
+    cached, head(backbone(x)) gives the logits. With 0 trainable blocks the
+    cached features are the pooled 1280-d vectors and only the classifier
+    trains.
+    """
+    cut = len(model.features) - trainable_blocks
+    if trainable_blocks:
+        backbone = model.features[:cut]
+        head = nn.Sequential(model.features[cut:], model.avgpool, nn.Flatten(1), model.classifier)
+    else:
+        backbone = nn.Sequential(model.features, model.avgpool, nn.Flatten(1))
+        head = model.classifier
+    for param in backbone.parameters():
+        param.requires_grad = False
+    return backbone.eval(), head
+
+
+def backbone_checksum(backbone):
+    """Identifies the frozen weights, so cached features are never reused for a different backbone."""
+    digest = hashlib.sha256(f"v{FEATURE_VERSION}".encode())
+    for name, tensor in backbone.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def freeze_batchnorm(module):
+    # Small incremental batches would drag the running statistics away from the full training set
+    for m in module.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.eval()
+
+
+def class_weights(targets, num_classes=NUM_CLASSES):
+    """Inverse-frequency weights normalised to sum to 1, as in model_training.ipynb, from real label counts."""
+    counts = np.bincount(np.asarray(targets), minlength=num_classes).astype(np.float64)
+    weights = 1.0 / np.maximum(counts, 1)
+    return torch.tensor(weights / weights.sum(), dtype=torch.float32)
+
+
+# ----------------------------
+# Feature Cache
+# ----------------------------
+def image_key(path):
+    """Changes whenever the file is replaced or edited, like evaluation.cache_key."""
+    stat = os.stat(path)
+    return hashlib.sha256(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:32]
+
+
+class FeatureCache:
+    """
+    Frozen-backbone outputs keyed by image, stored as append-only chunks of
+    ``chunk-NNNNN.f16.npy`` (float16 features, memory-mapped on read) and
+    ``chunk-NNNNN.keys.npy``. The key file is written last, so a chunk cut
+    short by an interrupted run is ignored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._chunks = []
+        self._rows = {}
+        for keys_path in sorted(glob.glob(os.path.join(directory, "chunk-*.keys.npy"))):
+            features = np.load(keys_path.replace(".keys.npy", ".f16.npy"), mmap_mode="r")
+            for row, key in enumerate(np.load(keys_path)):
+                self._rows[key.decode()] = (len(self._chunks), row)
+            self._chunks.append(features)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, keys, features):
+        base = os.path.join(self.directory, f"chunk-{len(self._chunks):05d}")
+        np.save(base + ".f16.npy", np.asarray(features, dtype=np.float16))
+        np.save(base + ".keys.npy", np.array([key.encode() for key in keys]))
+        chunk = len(self._chunks)
+        self._chunks.append(np.load(base + ".f16.npy", mmap_mode="r"))
+        for row, key in enumerate(keys):
+            self._rows[key] = (chunk, row)
+
+    def get(self, keys):
+        """Stacks the cached features of ``keys`` into one in-memory float16 array."""
+        first = self._chunks[self._rows[keys[0]][0]]
+        out = np.empty((len(keys),) + first.shape[1:], dtype=np.float16)
+        for i, key in enumerate(keys):
+            chunk, row = self._rows[key]
+            out[i] = self._chunks[chunk][row]
+        return out
+
+
+def dataset_keys(dataset):
+    return [image_key(path) for path, _ in dataset.samples]
+
+
+def encode_missing(backbone, dataset, keys, cache, device, batch_size, num_workers=0):
+    """Runs the backbone over the images of ``dataset`` (with ``keys``) not yet in ``cache``."""
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    if not missing:
+        return
+
+    print(f"Encoding {len(missing)} images without cached features...")
+    loader = DataLoader(Subset(dataset, missing), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    pending_keys, pending = [], []
+    offset = 0
+    with torch.no_grad():
+        for images, _ in loader:
+            pending.append(backbone(images.to(device)).cpu().numpy())
+            pending_keys.extend(keys[i] for i in missing[offset:offset + len(images)])
+            offset += len(images)
+            if len(pending_keys) >= CHUNK_ROWS:
+                cache.add(pending_keys, np.concatenate(pending))
+                pending_keys, pending = [], []
+    if pending_keys:
+        cache.add(pending_keys, np.concatenate(pending))
+
+
+# ----------------------------
+# Seen-Image Ledger
+# ----------------------------
+def ledger_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + ".seen.txt"
+
+
+def load_ledger(checkpoint_path):
+    path = ledger_path(checkpoint_path)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def save_ledger(checkpoint_path, keys):
+    with open(ledger_path(checkpoint_path), "w") as f:
+        f.writelines(f"{key}\n" for key in sorted(keys))
+
+
+# ----------------------------
+# Training
+# ----------------------------
+def head_logits(head, features, device, batch_size=256):
+    head.eval()
+    logits = []
+    with torch.no_grad():
+        for start in range(0, len(features), batch_size):
+            batch = torch.from_numpy(features[start:start + batch_size]).float().to(device)
+            logits.append(head(batch).cpu())
+    return torch.cat(logits).numpy()
+
+
+def train_head(head, features, targets, weights, device, epochs=5, lr=1e-3, batch_size=64, val=None):
+    """Trains ``head`` on cached features; keeps the epoch with the best validation accuracy if ``val`` is given."""
+    params = [p for p in head.parameters() if p.requires_grad]
+    criterion = nn.CrossEntropyLoss(weight=weights.to(device))
+    optimizer = optim.Adam(params, lr=lr)
+    targets = torch.as_tensor(targets)
+    best_acc, best_state = -1.0, None
+
+    for epoch in range(epochs):
+        head.train()
+        freeze_batchnorm(head)
+        running_loss, running_corrects = 0.0, 0
+        for idx in torch.randperm(len(targets)).split(batch_size):
+            inputs = torch.from_numpy(features[idx.numpy()]).float().to(device)
+            labels = targets[idx].to(device)
+
+            optimizer.zero_grad()
+            outputs = head(inputs)
+            loss = criterion(outputs, labels)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item() * len(idx)
+            running_corrects += (outputs.argmax(dim=1) == labels).sum().item()
+
+        line = (f"Epoch {epoch + 1}/{epochs} Train Loss: {running_loss / len(targets):.4f} "
+                f"Train Acc: {running_corrects / len(targets):.4f}")
+        if val is not None:
+            val_features, val_targets = val
+            val_acc = (head_logits(head, val_features, device).argmax(axis=1) == val_targets).mean()
+            line += f" Val Acc: {val_acc:.4f}"
+            if val_acc > best_acc:
+                best_acc, best_state = val_acc, copy.deepcopy(head.state_dict())
+        print(line)
+
+    if best_state is not None:
+        head.load_state_dict(best_state)
+    return head
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True, help="ImageFolder with all reviewed images, old and new")
+    parser.add_argument("--base", default="best_model.pth", help="checkpoint to continue from")
+    parser.add_argument("--output", default="best_model_incremental.pth")
+    parser.add_argument("--val-dir", help="ImageFolder used to pick the best epoch and fit the calibration")
+    parser.add_argument("--trainable-blocks", type=int, default=0, choices=range(4),
+                        help="EfficientNet stages to fine-tune besides the classifier (0 = classifier only)")
+    parser.add_argument("--replay-ratio", type=float, default=2.0, help="previously seen images per new image")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--cache-dir", default="feature_cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write-calibration", metavar="PATH", help="save the fitted temperature/threshold for the server")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    if args.write_calibration and not args.val_dir:
+        parser.error("--write-calibration needs --val-dir")
+
+    start = time.perf_counter()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    dataset = datasets.ImageFolder(args.data_dir, transform=eval_transform("none"))
+    keys = dataset_keys(dataset)
+    seen = load_ledger(args.base)
+    new = [i for i, key in enumerate(keys) if key not in seen]
+    old = [i for i, key in enumerate(keys) if key in seen]
+    if not new:
+        print(f"No new images in {args.data_dir} since {args.base} was trained; nothing to do.")
+        return
+
+    model = load_model(args.base, device)
+    backbone, head = split_model(model, args.trainable_blocks)
+    cache = FeatureCache(os.path.join(args.cache_dir, f"{backbone_checksum(backbone)[:16]}-{args.trainable_blocks}"))
+    encode_missing(backbone, dataset, keys, cache, device, args.batch_size, args.num_workers)
+    rng = np.random.default_rng(args.seed)
+    replay = rng.choice(old, min(len(old), int(round(args.replay_ratio * len(new)))), replace=False).tolist()
+    selected = new + replay
+    targets = np.asarray(dataset.targets)[selected]
+    weights = class_weights(targets)
+    print(f"{len(new)} new + {len(replay)} replayed images; class weights {weights.numpy().round(4).tolist()}")
+
+    val = None
+    if args.val_dir:
+        val_dataset = datasets.ImageFolder(args.val_dir, transform=eval_transform("none"))
+        val_keys = dataset_keys(val_dataset)
+        encode_missing(backbone, val_dataset, val_keys, cache, device, args.batch_size, args.num_workers)
+        val = (cache.get(val_keys), np.asarray(val_dataset.targets))
+
+    features = cache.get([keys[i] for i in selected])
+    train_head(head, features, targets, weights, device, args.epochs, args.lr, args.batch_size, val)
+
+    torch.save(model.state_dict(), args.output)
+    save_ledger(args.output, seen | {keys[i] for i in new})
+    print(f"✅ Model saved as {args.output} in {time.perf_counter() - start:.0f} s")
+
+    if val is not None:
+        metrics = compute_metrics(head_logits(head, val[0], device), val[1])
+        print_metrics(metrics)
+        if args.write_calibration:
+            save_calibration(args.write_calibration, metrics, model_checksum(args.output))
+            print(f"✅ Calibration saved as {args.write_calibration}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""
+Shared inference core for the servers, notebooks, benchmarks and clients.
+
+    from inference import Pipeline
+
+    pipeline = Pipeline.from_calibration("best_model.pth")
+    pipeline.predict(["face1.jpg", "face2.png"])   # [(label, confidence), ...]
+
+Importing the package only loads the standard library; torch, torchvision,
+OpenCV and PIL are imported by the stage that needs them. The package does not
+import any of the top-level scripts, so it can be used without them on the path.
+"""
+from .calibration import CALIBRATION_PATH, DEFAULT_CALIBRATION, load_calibration, model_checksum, save_calibration
+from .embedding import EMBEDDING_DIM, forward_with_embeddings, predict_with_embeddings
+from .face import FaceDetector
+from .model import LABELS, MODEL_PATH, NUM_CLASSES, build_model, default_device, load_model
+from .pipeline import NO_FACE, Pipeline
+from .preprocessing import DRAFT_SIZE, decode_image, eval_transform, open_image, train_transform
+from .tta import CROP_SIZE, MEAN, STD, TTA_MODES, check_mode, make_views, num_views, predict_logits, predict_proba
@@ -0,0 +1,64 @@
+"""
+Checkpoint checksums and the per-TTA-mode decision rule in ``calibration.json``.
+
+The file is written by ``evaluation.py``, ``incremental_training.py`` and
+``model_testing(new).ipynb``. Logits differ per TTA mode, so each mode gets
+its own temperature/threshold:
+{"model_checksum": ..., "modes": {"none": {"temperature": ..., "threshold": ...}, ...}}
+"""
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+CALIBRATION_PATH = "calibration.json"
+DEFAULT_CALIBRATION = {"temperature": 1.0, "threshold": 0.5}   # plain argmax
+
+
+def model_checksum(model_path, chunk_size=1 << 20):
+    """SHA-256 of the checkpoint file; identifies the weights logits were computed with."""
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_modes(calibration):
+    if "modes" in calibration:
+        return calibration["modes"]
+    # Single-mode files written before calibrations were keyed by TTA mode
+    return {calibration.get("tta_mode", "none"): {"temperature": calibration["temperature"],
+                                                   "threshold": calibration["threshold"]}}
+
+
+def save_calibration(path, metrics, checksum, tta_mode="none"):
+    """Stores the fit for ``tta_mode``, keeping other modes already fitted for the same checkpoint."""
+    modes = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = json.load(f)
+        if existing.get("model_checksum") == checksum:
+            modes = _read_modes(existing)
+    modes[tta_mode] = {"temperature": metrics["temperature"], "threshold": metrics["threshold"]}
+    with open(path, "w") as f:
+        json.dump({"model_checksum": checksum, "modes": modes}, f, indent=2)
+
+
+def load_calibration(path, checksum):
+    """
+    Returns {tta_mode: {"temperature", "threshold"}} for the modes fitted for
+    this checkpoint; empty if the file is missing or stale. Modes without an
+    entry should use ``DEFAULT_CALIBRATION`` (plain argmax).
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        calibration = json.load(f)
+    if calibration.get("model_checksum") != checksum:
+        logger.warning(f"Ignoring {path}: it was fitted for a different model checkpoint")
+        return {}
+    return {mode: {"temperature": float(fit["temperature"]), "threshold": float(fit["threshold"])}
+            for mode, fit in _read_modes(calibration).items()}
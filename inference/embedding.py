@@ -0,0 +1,26 @@
+"""
+The 1280-d backbone embedding, produced in the same forward pass as the logits.
+"""
+from .tta import make_views
+
+EMBEDDING_DIM = 1280
+
+
+def forward_with_embeddings(model, views):
+    """EfficientNet forward that also returns the pooled features: (logits, embeddings)."""
+    import torch
+
+    features = model.avgpool(model.features(views))
+    embeddings = torch.flatten(features, 1)
+    return model.classifier(embeddings), embeddings
+
+
+def predict_with_embeddings(model, batch, mode="none"):
+    """Like ``predict_logits`` but also returns the view-averaged embedding (B, 1280)."""
+    import torch
+
+    views = make_views(batch, mode)
+    with torch.no_grad():
+        logits, embeddings = forward_with_embeddings(model, views)
+    b = batch.shape[0]
+    return logits.view(b, -1, logits.shape[1]).mean(dim=1), embeddings.view(b, -1, embeddings.shape[1]).mean(dim=1)
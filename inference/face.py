@@ -0,0 +1,46 @@
+"""
+Haar-cascade face check shared by the servers and the desktop client.
+"""
+SCALE_FACTOR = 1.1
+MIN_NEIGHBORS = 5
+MIN_FACE_SIZE = (60, 60)
+
+
+class FaceDetector:
+    """Loads the OpenCV cascade on first use, so importing this module does not import cv2."""
+
+    def __init__(self, scale_factor=SCALE_FACTOR, min_neighbors=MIN_NEIGHBORS, min_size=MIN_FACE_SIZE):
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self._cascade = None
+
+    @property
+    def cascade(self):
+        if self._cascade is None:
+            import cv2
+
+            self._cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        return self._cascade
+
+    def detect_gray(self, gray):
+        """Face boxes (x, y, w, h) in a grayscale uint8 array."""
+        return self.cascade.detectMultiScale(gray, scaleFactor=self.scale_factor,
+                                             minNeighbors=self.min_neighbors, minSize=self.min_size)
+
+    def has_face(self, pil_image):
+        import cv2
+        import numpy as np
+
+        # RGB -> gray directly; same weights as flipping to BGR first, without the copy
+        gray = cv2.cvtColor(np.asarray(pil_image.convert("RGB")), cv2.COLOR_RGB2GRAY)
+        return len(self.detect_gray(gray)) > 0
+
+    def has_face_in_file(self, path):
+        """False for files OpenCV cannot read."""
+        import cv2
+
+        image = cv2.imread(path)
+        if image is None:
+            return False
+        return len(self.detect_gray(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))) > 0
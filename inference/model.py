@@ -0,0 +1,44 @@
+"""
+EfficientNet-B0 construction and checkpoint loading, the single copy every entry point uses.
+
+torch/torchvision are imported inside the functions so importing the
+package stays cheap for clients that only need face detection.
+"""
+MODEL_PATH = "best_model.pth"
+LABELS = ["drug_user", "not_user"]   # ImageFolder order; class 0 is the positive class
+NUM_CLASSES = len(LABELS)
+
+
+def default_device():
+    import torch
+
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def build_model(weights=None, num_classes=NUM_CLASSES):
+    """EfficientNet-B0 with a ``num_classes`` head; ``weights="IMAGENET1K_V1"`` for training from ImageNet."""
+    import torch.nn as nn
+    from torchvision.models import efficientnet_b0
+
+    model = efficientnet_b0(weights=weights)
+    model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
+    return model
+
+
+def load_model(model_path=MODEL_PATH, device=None):
+    """Loads a checkpoint saved as a state_dict or as ``{"state_dict": ...}``, with or without DataParallel."""
+    import torch
+
+    device = device or default_device()
+    checkpoint = torch.load(model_path, map_location=device)
+    if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
+        checkpoint = checkpoint["state_dict"]
+
+    model = build_model()
+    # Remove "module." prefix if trained with DataParallel
+    state_dict = {k[len("module."):] if k.startswith("module.") else k: v for k, v in checkpoint.items()}
+    model.load_state_dict(state_dict)
+
+    model.to(device)
+    model.eval()
+    return model
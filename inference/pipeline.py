@@ -0,0 +1,149 @@
+"""
+The batch-first inference pipeline: decode -> detect -> preprocess -> infer -> postprocess.
+
+Each stage takes and returns a whole batch, so an optimisation made here
+(batching, caching, another backend) reaches the servers, notebooks and
+benchmarks at once. Heavy dependencies are imported when a stage first runs.
+"""
+from .calibration import CALIBRATION_PATH, DEFAULT_CALIBRATION, load_calibration, model_checksum
+from .embedding import predict_with_embeddings
+from .face import FaceDetector
+from .model import LABELS, MODEL_PATH, default_device, load_model
+from .preprocessing import decode_image, eval_transform, open_image
+from .tta import predict_logits
+
+NO_FACE = "no_face_detected"
+POSITIVE_CLASS = 0            # drug_user
+
+
+class Pipeline:
+    """
+    One model plus its decision rule. ``calibration`` maps a TTA mode to the
+    temperature and threshold (on P(drug_user)) fitted for it in
+    ``calibration.json``; modes without a fit use plain argmax. The model loads
+    on first use; assign ``pipeline.model`` to swap in a converted copy, and
+    set ``channels_last`` when that copy is channels_last so the input batches
+    match it.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, device=None, tta_mode="none", calibration=None,
+                 detect_faces=True, face_detector=None, channels_last=False):
+        self.model_path = model_path
+        self.tta_mode = tta_mode
+        self.calibration = calibration or {}
+        self.channels_last = channels_last
+        self.detect_faces = detect_faces
+        self.face_detector = face_detector or FaceDetector()
+        self._device = device
+        self._model = None
+        self._transforms = {}
+
+    @classmethod
+    def from_calibration(cls, model_path=MODEL_PATH, calibration_path=CALIBRATION_PATH, **kwargs):
+        """A pipeline using the per-mode temperature/threshold fitted for this exact checkpoint, if any."""
+        return cls(model_path, calibration=load_calibration(calibration_path, model_checksum(model_path)), **kwargs)
+
+    @property
+    def device(self):
+        if self._device is None:
+            self._device = default_device()
+        return self._device
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = load_model(self.model_path, self.device)
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def load(self):
+        """Loads the model now (e.g. at server startup) instead of on first use."""
+        return self.model
+
+    def transform(self, tta_mode=None):
+        mode = tta_mode or self.tta_mode
+        if mode not in self._transforms:
+            self._transforms[mode] = eval_transform(mode)
+        return self._transforms[mode]
+
+    # ----------------------------
+    # Stages
+    # ----------------------------
+    def decode(self, items):
+        """Bytes, file paths or (lazily opened) PIL images -> RGB PIL images."""
+        return [decode_image(open_image(item)) for item in items]
+
+    def detect(self, images):
+        """One bool per image; all True when face detection is off."""
+        if not self.detect_faces:
+            return [True] * len(images)
+        return [self.face_detector.has_face(image) for image in images]
+
+    def preprocess(self, images, tta_mode=None):
+        """RGB images -> one normalised (B, 3, S, S) batch on the model's device."""
+        import torch
+
+        transform = self.transform(tta_mode)
+        batch = torch.stack([transform(image) for image in images])
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch.to(self.device)
+
+    def infer(self, batch, tta_mode=None):
+        """View-averaged logits (B, 2); every TTA view of every image runs in one forward pass."""
+        return predict_logits(self.model, batch, tta_mode or self.tta_mode)
+
+    def infer_with_embeddings(self, batch, tta_mode=None):
+        """(logits (B, 2), backbone embeddings (B, 1280)) from the same forward pass."""
+        return predict_with_embeddings(self.model, batch, tta_mode or self.tta_mode)
+
+    def decision_rule(self, tta_mode=None):
+        """{"temperature", "threshold"} fitted for ``tta_mode``; argmax for modes never calibrated."""
+        return self.calibration.get(tta_mode or self.tta_mode, DEFAULT_CALIBRATION)
+
+    def decision_key(self, tta_mode=None):
+        """Identifies the verdicts of ``tta_mode`` (mode, temperature, threshold), e.g. to reuse stored ones."""
+        mode = tta_mode or self.tta_mode
+        rule = self.decision_rule(mode)
+        return f"{mode}|{rule['temperature']!r}|{rule['threshold']!r}"
+
+    def probabilities(self, logits, tta_mode=None):
+        """Temperature-scaled P(drug_user) per image."""
+        import torch
+
+        temperature = self.decision_rule(tta_mode)["temperature"]
+        return torch.softmax(logits / temperature, dim=1)[:, POSITIVE_CLASS].tolist()
+
+    def postprocess(self, logits, tta_mode=None):
+        """[(label, confidence)] per image; confidence is the probability of the returned label."""
+        threshold = self.decision_rule(tta_mode)["threshold"]
+        results = []
+        for drug_user_prob in self.probabilities(logits, tta_mode):
+            if drug_user_prob >= threshold:
+                results.append((LABELS[0], drug_user_prob))
+            else:
+                results.append((LABELS[1], 1.0 - drug_user_prob))
+        return results
+
+    # ----------------------------
+    # End to End
+    # ----------------------------
+    def predict(self, items, tta_mode=None, batch_size=32):
+        """
+        Runs every stage over ``items`` in batches of ``batch_size`` and returns
+        one (label, confidence) per item, ``(NO_FACE, 0.0)`` where no face was found.
+        """
+        results = []
+        for start in range(0, len(items), batch_size):
+            images = self.decode(items[start:start + batch_size])
+            faces = [i for i, has_face in enumerate(self.detect(images)) if has_face]
+            batch_results = [(NO_FACE, 0.0)] * len(images)
+            if faces:
+                logits = self.infer(self.preprocess([images[i] for i in faces], tta_mode), tta_mode)
+                for i, result in zip(faces, self.postprocess(logits, tta_mode)):
+                    batch_results[i] = result
+            results.extend(batch_results)
+        return results
@@ -0,0 +1,65 @@
+"""
+Image decoding and the tensor transforms for training, evaluation and serving.
+
+Training and inference share one resize and normalisation, so the model sees
+the same inputs in ``model_training.ipynb``, the evaluators and the servers.
+"""
+import io
+import os
+
+from .tta import CROP_SIZE, MEAN, STD, TTA_MODES, check_mode
+
+DRAFT_SIZE = (448, 448)   # smallest size a large JPEG is draft-decoded down to
+
+
+def open_image(item):
+    """Lazily opens bytes or a file path with PIL (header only); PIL images pass through."""
+    from PIL import Image
+
+    if isinstance(item, (bytes, bytearray)):
+        return Image.open(io.BytesIO(item))
+    if isinstance(item, (str, os.PathLike)):
+        return Image.open(item)
+    return item
+
+
+def decode_image(image, draft_size=DRAFT_SIZE):
+    """
+    Decodes a lazily opened image to RGB. JPEGs much larger than the model
+    input are decoded with ``Image.draft`` at 1/2, 1/4 or 1/8 scale, which skips
+    most of the IDCT work and keeps the decoded buffer small.
+    """
+    if image.format == "JPEG":
+        width, height = image.size
+        if width >= 2 * draft_size[0] and height >= 2 * draft_size[1]:
+            image.draft("RGB", draft_size)
+    return image.convert("RGB")
+
+
+def eval_transform(tta_mode="none"):
+    """
+    Per-image transform feeding ``make_views``. The resize is square like the
+    training transform, so "none" matches what the model was trained on.
+    """
+    from torchvision import transforms
+
+    size = TTA_MODES[check_mode(tta_mode)][0]
+    return transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD),
+    ])
+
+
+def train_transform():
+    """The augmentations of ``model_training.ipynb`` around the serving resize and normalisation."""
+    from torchvision import transforms
+
+    return transforms.Compose([
+        transforms.Resize((CROP_SIZE, CROP_SIZE)),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(10),
+        transforms.ColorJitter(brightness=0.2, contrast=0.2),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD),
+    ])
@@ -0,0 +1,83 @@
+"""
+Test-time augmentation: every view of every image goes through the model in
+one forward pass and the logits are averaged per image.
+
+The mode table is plain data; torch is imported by the functions that need it.
+"""
+CROP_SIZE = 224
+MULTICROP_RESIZE = 256
+
+# mode -> (resize size, use five crops, add horizontal flips)
+TTA_MODES = {
+    "none": (CROP_SIZE, False, False),
+    "flip": (CROP_SIZE, False, True),
+    "five_crop": (MULTICROP_RESIZE, True, False),
+    "five_crop_flip": (MULTICROP_RESIZE, True, True),
+}
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def check_mode(mode):
+    if mode not in TTA_MODES:
+        raise ValueError(f"Unknown TTA mode {mode!r}, expected one of {list(TTA_MODES)}")
+    return mode
+
+
+def num_views(mode):
+    _, five_crop, flip = TTA_MODES[check_mode(mode)]
+    return (5 if five_crop else 1) * (2 if flip else 1)
+
+
+def _five_crop_index(size, crop, device):
+    """Row/column gather indices for the four corner crops and the center crop."""
+    import torch
+
+    far = size - crop
+    mid = far // 2
+    offsets = torch.tensor([[0, 0], [0, far], [far, 0], [far, far], [mid, mid]], device=device)
+    steps = torch.arange(crop, device=device)
+    rows = (offsets[:, 0, None] + steps)[:, :, None]   # (5, crop, 1)
+    cols = (offsets[:, 1, None] + steps)[:, None, :]   # (5, 1, crop)
+    return rows, cols
+
+
+def make_views(batch, mode="none"):
+    """
+    Expands a preprocessed batch (B, C, H, W) into all TTA views at once and
+    returns a (B * V, C, 224, 224) tensor laid out image-major. Crops are taken
+    with a single advanced-indexing gather and flips with one ``flip`` call.
+    """
+    import torch
+
+    _, five_crop, flip = TTA_MODES[check_mode(mode)]
+    if five_crop:
+        rows, cols = _five_crop_index(batch.shape[-1], CROP_SIZE, batch.device)
+        views = batch[:, :, rows, cols].transpose(1, 2)     # (B, 5, C, crop, crop)
+    else:
+        views = batch.unsqueeze(1)                          # (B, 1, C, H, W)
+    if flip:
+        views = torch.cat([views, views.flip(-1)], dim=1)
+    views = views.reshape(-1, *views.shape[2:])
+    if batch.is_contiguous(memory_format=torch.channels_last) and not batch.is_contiguous():
+        # Gathers and flips return NCHW; keep a channels_last batch channels_last for a channels_last model
+        views = views.contiguous(memory_format=torch.channels_last)
+    return views
+
+
+def predict_logits(model, batch, mode="none"):
+    """Runs every view of every image in one forward pass and returns view-averaged logits (B, 2)."""
+    import torch
+
+    views = make_views(batch, mode)
+    with torch.no_grad():
+        logits = model(views)
+    return logits.view(batch.shape[0], -1, logits.shape[1]).mean(dim=1)
+
+
+def predict_proba(model, batch, mode="none", temperature=1.0):
+    """Class probabilities (B, 2) from the view-averaged logits, optionally temperature-scaled."""
+    import torch
+
+    return torch.softmax(predict_logits(model, batch, mode) / temperature, dim=1)
@@ -0,0 +1,167 @@
+import io
+
+from PIL import Image
+
+from admission import AdmissionRejected, check_image_pixels
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # older python-multipart releases
+    import multipart
+    from multipart.multipart import parse_options_header
+
+# ----------------------------
+# Ingestion Settings
+# ----------------------------
+ALLOWED_FORMATS = {"JPEG", "PNG"}
+MULTIPART_OVERHEAD_BYTES = 64 * 1024   # boundaries, part headers and other form fields
+FIRST_PROBE_BYTES = 2 * 1024           # header sniffing starts once this much has arrived
+
+# Magic numbers for the formats we accept; anything else is refused on the first chunk.
+SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")
+
+
+# ----------------------------
+# Header Sniffing
+# ----------------------------
+def sniff_image(data, max_pixels):
+    """
+    Opens an image lazily (PIL only parses the header) and rejects unsupported
+    formats and oversized dimensions before any pixel data is decoded.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        # PIL refuses headers above 2 x MAX_IMAGE_PIXELS itself; that is a size problem, not corruption
+        raise AdmissionRejected(413, f"Image too large: {e}")
+    except Exception:
+        raise AdmissionRejected(415, "Unsupported or corrupt image")
+    if image.format not in ALLOWED_FORMATS:
+        raise AdmissionRejected(415, f"Unsupported image format: {image.format}")
+    check_image_pixels(image, max_pixels)
+    return image
+
+
+def check_signature(head):
+    if len(head) >= 8 and not head.startswith(SIGNATURES):
+        raise AdmissionRejected(415, "Unsupported image type")
+
+
+# ----------------------------
+# Streaming Multipart Reader
+# ----------------------------
+class _FilePartCollector:
+    """Multipart callbacks that keep only the wanted file field, within a byte limit."""
+
+    def __init__(self, field_name, max_bytes, max_pixels):
+        self.field_name = field_name
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.filename = None
+        self.data = None
+        self.header_checked = False
+        self._buffer = bytearray()
+        self._in_field = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._next_probe = FIRST_PROBE_BYTES
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._in_field = False
+
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name", b"").decode("latin-1") == self.field_name and self.data is None:
+            self._in_field = True
+            self.filename = options.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(self, data, start, end):
+        if not self._in_field:
+            return
+        self._buffer += data[start:end]
+        if len(self._buffer) > self.max_bytes:
+            raise AdmissionRejected(413, f"Upload exceeds {self.max_bytes} bytes")
+        if not self.header_checked and len(self._buffer) >= self._next_probe:
+            self._probe()
+
+    def on_part_end(self):
+        if self._in_field:
+            self.data = bytes(self._buffer)
+            self._buffer = bytearray()
+            self._in_field = False
+
+    def _probe(self):
+        """Tries to read format and dimensions from what has arrived so far."""
+        head = bytes(self._buffer)
+        check_signature(head)
+        try:
+            image = Image.open(io.BytesIO(head))
+        except Image.DecompressionBombError as e:
+            raise AdmissionRejected(413, f"Image too large: {e}")
+        except Exception:
+            # Header not complete yet (e.g. long EXIF block); try again with more data.
+            self._next_probe *= 2
+            return
+        if image.format not in ALLOWED_FORMATS:
+            raise AdmissionRejected(415, f"Unsupported image format: {image.format}")
+        check_image_pixels(image, self.max_pixels)
+        self.header_checked = True
+
+
+async def read_upload(request, max_bytes, max_pixels, field_name="file"):
+    """
+    Streams a multipart/form-data body and returns ``(filename, data, image)``
+    for ``field_name``, where ``image`` is a lazily opened PIL image. The body
+    is never buffered beyond ``max_bytes``, and type/size problems are rejected
+    as soon as the image header has arrived instead of after the full upload.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        raise AdmissionRejected(413, f"Upload exceeds {max_bytes} bytes")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise AdmissionRejected(415, "Expected a multipart/form-data upload")
+
+    collector = _FilePartCollector(field_name, max_bytes, max_pixels)
+    parser = multipart.MultipartParser(params[b"boundary"], collector.callbacks())
+
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes + MULTIPART_OVERHEAD_BYTES:
+            raise AdmissionRejected(413, f"Upload exceeds {max_bytes} bytes")
+        parser.write(chunk)
+    parser.finalize()
+
+    if collector.data is None:
+        raise AdmissionRejected(400, f"Missing form field '{field_name}'")
+
+    # Small images may finish streaming before the first probe threshold.
+    image = sniff_image(collector.data, max_pixels)
+    return collector.filename, collector.data, image
@@ -0,0 +1,211 @@
+"""
+Append-only audit log of predictions, written off the request path.
+
+``PredictionLog.record`` only puts a row on an in-memory queue; a background
+thread drains the queue in batches into SQLite files in WAL mode, rotating to
+a new file after ``max_rows_per_file`` rows and deleting the oldest files
+beyond ``max_files``. When the queue is full rows are dropped and counted
+rather than slowing down inference.
+"""
+import glob
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = (
+    "ts", "content_hash", "label", "confidence", "model_version", "tta_mode",
+    "queue_ms", "decode_ms", "detect_ms", "infer_ms", "total_ms",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    ts REAL NOT NULL,
+    content_hash BLOB,
+    label TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    model_version TEXT,
+    tta_mode TEXT,
+    queue_ms REAL,
+    decode_ms REAL,
+    detect_ms REAL,
+    infer_ms REAL,
+    total_ms REAL
+);
+CREATE INDEX IF NOT EXISTS idx_predictions_ts ON predictions (ts);
+CREATE INDEX IF NOT EXISTS idx_predictions_label_ts ON predictions (label, ts);
+CREATE INDEX IF NOT EXISTS idx_predictions_confidence ON predictions (confidence);
+"""
+
+_STOP = object()
+
+
+class PredictionLog:
+    """Batched, asynchronous SQLite writer plus a filtered query over all log files."""
+
+    def __init__(self, directory, max_rows_per_file=1_000_000, max_files=30,
+                 batch_size=256, flush_interval=0.5, max_queue=10000):
+        self.directory = directory
+        self.max_rows_per_file = max_rows_per_file
+        self.max_files = max_files
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        os.makedirs(directory, exist_ok=True)
+
+        self._thread = threading.Thread(target=self._run, name="prediction-log", daemon=True)
+        self._thread.start()
+
+    # ----------------------------
+    # Request path
+    # ----------------------------
+    def record(self, **fields):
+        """Queues one prediction; never blocks. ``content_hash`` may be a hex string."""
+        content_hash = fields.get("content_hash")
+        if isinstance(content_hash, str):
+            fields["content_hash"] = bytes.fromhex(content_hash)
+        fields.setdefault("ts", time.time())
+        try:
+            self._queue.put_nowait(tuple(fields.get(column) for column in COLUMNS))
+        except queue.Full:
+            self.dropped += 1
+
+    # ----------------------------
+    # Writer thread
+    # ----------------------------
+    def _files(self):
+        return sorted(glob.glob(os.path.join(self.directory, "predictions-*.db")))
+
+    def _open_writer(self, path=None):
+        if path is None:
+            path = os.path.join(self.directory, time.strftime("predictions-%Y%m%d-%H%M%S.db"))
+            # Two rotations within a second must not reuse a file name
+            suffix = 1
+            base = path[:-3]
+            while os.path.exists(path):
+                path = f"{base}_{suffix:03d}.db"
+                suffix += 1
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        rows = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        return conn, rows
+
+    def _prune(self):
+        files = self._files()
+        # Keep max_files - 1 old files; the one opened next makes max_files
+        for path in files[:max(len(files) - self.max_files + 1, 0)]:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                except OSError as e:
+                    logger.warning(f"Could not delete old prediction log {path + suffix}: {e}")
+
+    def _writer(self, conn, rows):
+        """Returns a writable (conn, rows): opens the newest file if needed and rotates a full one."""
+        if conn is None:
+            files = self._files()
+            conn, rows = self._open_writer(files[-1] if files else None)
+        if rows >= self.max_rows_per_file:
+            conn.close()
+            self._prune()
+            conn, rows = self._open_writer()
+        return conn, rows
+
+    def _run(self):
+        # Any failure drops the batch and closes the connection; the next batch reopens it,
+        # so the thread keeps running (and logging) instead of dying silently
+        conn, rows = None, 0
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [row for row in batch if row is not _STOP]
+            if not batch:
+                continue
+
+            try:
+                conn, rows = self._writer(conn, rows)
+                with conn:
+                    conn.executemany(
+                        f"INSERT INTO predictions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                        batch,
+                    )
+                rows += len(batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.error(f"Prediction log write failed, dropped {len(batch)} rows: {e}")
+                conn = self._close_quietly(conn)
+        self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        return None
+
+    def close(self, timeout=5.0):
+        """Flushes queued rows and stops the writer thread, waiting at most about ``timeout`` seconds."""
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning(f"Prediction log writer is not draining; {self._queue.qsize()} queued rows are lost")
+            return
+        self._thread.join(timeout)
+
+    # ----------------------------
+    # Queries
+    # ----------------------------
+    def query(self, start=None, end=None, label=None, min_confidence=None, max_confidence=None, limit=100):
+        """Newest-first rows matching all given filters, across rotated files."""
+        clauses, params = [], []
+        for clause, value in (("ts >= ?", start), ("ts < ?", end), ("label = ?", label),
+                              ("confidence >= ?", min_confidence), ("confidence <= ?", max_confidence)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT {', '.join(COLUMNS)} FROM predictions {where} ORDER BY ts DESC LIMIT ?"
+
+        results = []
+        for path in reversed(self._files()):
+            if len(results) >= limit:
+                break
+            try:
+                conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+                try:
+                    rows = conn.execute(sql, params + [limit - len(results)]).fetchall()
+                finally:
+                    conn.close()
+            except sqlite3.Error:
+                continue  # removed by rotation in the meantime
+            for row in rows:
+                item = dict(zip(COLUMNS, row))
+                if item["content_hash"] is not None:
+                    item["content_hash"] = item["content_hash"].hex()
+                results.append(item)
+        return results
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
@@ -0,0 +1,250 @@
+"""
+On-demand request profiler for the inference server.
+
+An admin starts a session for the next N predictions or T seconds. While it
+runs, every wrapped ``predict_image`` call is recorded with
+``torch.profiler`` (one Chrome trace per call), stage blocks are labelled via
+``record_function``, and a background thread samples the Python stacks of
+the worker threads inside wrapped calls into a folded-stack file that flamegraph.pl
+or speedscope can render. torch.profiler allows one session per process, so a
+call that overlaps a traced one is only stack-sampled. When no session is
+active every hook is a single attribute check.
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005
+
+
+class RequestProfiler:
+    """Admin-triggered profiling session shared by the wrapped functions of one process."""
+
+    def __init__(self, output_dir="profiles"):
+        self.output_dir = output_dir
+        self.active = False
+        self.session_dir = None
+        self._lock = threading.Lock()
+        self._trace_lock = threading.Lock()     # held by the one call being traced
+        self._local = threading.local()
+        self._threads = Counter()
+        self._reset()
+
+    def _reset(self):
+        self._remaining = 0
+        self._until = 0.0
+        self._calls = 0
+        self._untraced = 0
+        self._ops = defaultdict(lambda: [0, 0.0])          # name -> [calls, self cpu us]
+        self._stages = defaultdict(lambda: [0, 0.0])       # name -> [calls, wall ms]
+        self._endpoints = defaultdict(lambda: [0, 0.0])    # name -> [calls, wall ms]
+        self._stacks = Counter()
+
+    # ----------------------------
+    # Session control
+    # ----------------------------
+    def start(self, requests=20, seconds=60.0):
+        with self._lock:
+            if self.active:
+                raise RuntimeError("A profiling session is already running")
+            self._reset()
+            self._remaining = requests
+            self._until = time.monotonic() + seconds
+            self.session_dir = os.path.join(self.output_dir, time.strftime("%Y%m%d-%H%M%S"))
+            os.makedirs(self.session_dir, exist_ok=True)
+            self.active = True
+        threading.Thread(target=self._sample, name="profiler-sampler", daemon=True).start()
+        logger.info(f"Profiling the next {requests} predictions or {seconds:.0f} s into {self.session_dir}")
+        return self.session_dir
+
+    def stop(self):
+        with self._lock:
+            if not self.active:
+                return
+            self.active = False
+            stacks = self._stacks.most_common()
+        with open(os.path.join(self.session_dir, "stacks.folded"), "w") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(self.session_dir, "summary.json"), "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        logger.info(f"Profiling finished after {self._calls} predictions; results in {self.session_dir}")
+
+    def _expired(self):
+        return time.monotonic() >= self._until
+
+    # ----------------------------
+    # Hooks
+    # ----------------------------
+    def profile_call(self, func):
+        """Wraps a synchronous function; profiled with torch.profiler while a session runs."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.active or getattr(self._local, "profiling", False):
+                return func(*args, **kwargs)
+            return self._run_profiled(func, args, kwargs)
+        return wrapper
+
+    def profile_endpoint(self, func):
+        """Wraps an async endpoint; records its wall time while a session runs.
+
+        The event loop thread is not stack-sampled: it mostly sits idle in
+        ``select`` while the inference runs in a worker thread.
+        """
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.active:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self._add(self._endpoints, func.__name__, (time.perf_counter() - start) * 1000)
+        return wrapper
+
+    def stage(self, name):
+        """Labels a block in the trace and stage totals; a no-op context when inactive."""
+        if not self.active:
+            return nullcontext()
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+        from torch.profiler import record_function
+
+        start = time.perf_counter()
+        with record_function(name):
+            yield
+        self._add(self._stages, name, (time.perf_counter() - start) * 1000)
+
+    # ----------------------------
+    # Recording
+    # ----------------------------
+    def _add(self, table, name, value):
+        with self._lock:
+            table[name][0] += 1
+            table[name][1] += value
+
+    @contextmanager
+    def _sampled_thread(self):
+        tid = threading.get_ident()
+        with self._lock:
+            self._threads[tid] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[tid] -= 1
+                if not self._threads[tid]:
+                    del self._threads[tid]
+
+    def _run_profiled(self, func, args, kwargs):
+        # Overlapping torch.profiler sessions crash the process inside Kineto,
+        # so calls that run while another one is traced are only stack-sampled
+        if not self._trace_lock.acquire(blocking=False):
+            return self._run_sampled(func, args, kwargs)
+        try:
+            return self._run_traced(func, args, kwargs)
+        finally:
+            self._trace_lock.release()
+
+    def _run_traced(self, func, args, kwargs):
+        from torch.profiler import ProfilerActivity, profile
+
+        self._local.profiling = True
+        try:
+            with self._sampled_thread(), profile(activities=[ProfilerActivity.CPU]) as prof:
+                result = func(*args, **kwargs)
+        finally:
+            self._local.profiling = False
+
+        call, done = self._count_call(prof)
+        prof.export_chrome_trace(os.path.join(self.session_dir, f"trace-{call:04d}-{func.__name__}.json"))
+        if done:
+            self.stop()
+        return result
+
+    def _run_sampled(self, func, args, kwargs):
+        self._local.profiling = True
+        try:
+            with self._sampled_thread():
+                result = func(*args, **kwargs)
+        finally:
+            self._local.profiling = False
+
+        _, done = self._count_call(None)
+        if done:
+            self.stop()
+        return result
+
+    def _count_call(self, prof):
+        """Counts a finished call towards the session; returns (call number, session done)."""
+        with self._lock:
+            self._calls += 1
+            self._remaining -= 1
+            if prof is None:
+                self._untraced += 1
+            else:
+                for event in prof.key_averages():
+                    self._ops[event.key][0] += event.count
+                    self._ops[event.key][1] += event.self_cpu_time_total
+            return self._calls, self._remaining <= 0 or self._expired()
+
+    def _sample(self):
+        while self.active:
+            if self._expired():
+                self.stop()
+                return
+            time.sleep(SAMPLE_INTERVAL)
+            with self._lock:
+                tids = list(self._threads)
+            frames = sys._current_frames()
+            stacks = []
+            for tid in tids:
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(stacks)
+
+    # ----------------------------
+    # Summary
+    # ----------------------------
+    def summary(self, top=20):
+        with self._lock:
+            ops = sorted(self._ops.items(), key=lambda item: item[1][1], reverse=True)[:top]
+            leaves = Counter()
+            for stack, count in self._stacks.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            total_samples = sum(leaves.values()) or 1
+            return {
+                "active": self.active,
+                "session_dir": self.session_dir,
+                "predictions": self._calls,
+                "untraced_predictions": self._untraced,   # overlapped a traced call; stack-sampled only
+                "top_operators": [
+                    {"name": name, "calls": calls, "self_cpu_ms": round(us / 1000, 3)}
+                    for name, (calls, us) in ops
+                ],
+                "stages": {name: {"calls": calls, "total_ms": round(ms, 3), "mean_ms": round(ms / calls, 3)}
+                           for name, (calls, ms) in self._stages.items()},
+                "endpoints": {name: {"calls": calls, "total_ms": round(ms, 3), "mean_ms": round(ms / calls, 3)}
+                              for name, (calls, ms) in self._endpoints.items()},
+                "top_python_frames": [
+                    {"frame": frame, "samples": count, "share": round(count / total_samples, 4)}
+                    for frame, count in leaves.most_common(top)
+                ],
+            }
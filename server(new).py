@@ -1,15 +1,23 @@
-import torch
-import torch.nn as nn
-from torchvision import models, transforms
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
-import io
 import base64
+import hashlib
 import json
 import logging
-import cv2
+import os
+import time
 import numpy as np
+from admission import (
+    INTERACTIVE, BULK, AdmissionRejected, Deadline, ClientLimiter, InferenceScheduler,
+    parse_priority,
+)
+from ingest import read_upload, sniff_image
+from inference import LABELS, NO_FACE, TTA_MODES, Pipeline, model_checksum
+from embeddings import VectorIndex
+from prediction_log import PredictionLog
+from cpu_tuning import LoadMonitor, apply_profile, check_oversubscription, load_profile
+from request_profiler import RequestProfiler
 
 # ----------------------------
 # Logging setup
@@ -21,80 +29,245 @@ logger = logging.getLogger(__name__)
 # Model setup
 # ----------------------------
 MODEL_PATH = "best_model.pth"
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-logger.info(f"Using device: {device}")
 
 try:
-    # Use EfficientNet B0
-    model = models.efficientnet_b0(pretrained=False)
-    model.classifier[1] = nn.Linear(model.classifier[1].in_features, 2)  # 2 classes: drug_user, not_user
-
-    # Load weights
-    checkpoint = torch.load(MODEL_PATH, map_location=device)
-    if isinstance(checkpoint, dict) and 'state_dict' in checkpoint:
-        model.load_state_dict(checkpoint['state_dict'])
-    else:
-        model.load_state_dict(checkpoint)
-
-    model.to(device)
-    model.eval()
+    # Decode, face detection, preprocessing, inference and the decision rule all live in the
+    # pipeline. calibration.json (evaluation.py / model_testing(new).ipynb) is applied per TTA
+    # mode when fitted for this checkpoint; other modes use plain argmax.
+    pipeline = Pipeline.from_calibration(MODEL_PATH)
+    logger.info(f"Using device: {pipeline.device}")
+    # Load now so a bad checkpoint fails at startup, not on the first request
+    pipeline.load()
     logger.info("Model loaded successfully")
 
 except Exception as e:
     logger.error(f"Error loading model: {e}")
     raise
 
+MODEL_CHECKSUM = model_checksum(MODEL_PATH)
+MODEL_VERSION = MODEL_CHECKSUM[:12]
+for mode, fit in pipeline.calibration.items():
+    logger.info(f"Calibration ({mode}): temperature={fit['temperature']:.3f}, threshold={fit['threshold']:.4f}")
+
+# ----------------------------
+# Admission Control Settings
+# ----------------------------
+DEFAULT_DEADLINE_MS = 10000        # used when the caller does not send a deadline
+MAX_DEADLINE_MS = 30000            # caller deadlines are clamped to this
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_DECODED_PIXELS = 4096 * 4096
+MAX_CONCURRENT_PER_CLIENT = 4
+MAX_INFLIGHT_INFERENCES = 2
+MAX_QUEUE = {INTERACTIVE: 32, BULK: 8}
+
+client_limiter = ClientLimiter(MAX_CONCURRENT_PER_CLIENT)
+scheduler = InferenceScheduler(MAX_INFLIGHT_INFERENCES, MAX_QUEUE)
+
+# ----------------------------
+# CPU Threading
+# ----------------------------
+# Written by cpu_tuning.py; sets torch/OpenCV thread counts and channels_last
+THREAD_PROFILE_PATH = "thread_profile.json"
+
+thread_profile = load_profile(THREAD_PROFILE_PATH)
+if thread_profile is not None:
+    pipeline.model = apply_profile(thread_profile, pipeline.model)
+    pipeline.channels_last = bool(thread_profile["channels_last"])
+    logger.info(f"Applied {THREAD_PROFILE_PATH}: {thread_profile['torch_num_threads']} torch threads, "
+                f"{thread_profile['cv2_num_threads']} OpenCV threads, channels_last={thread_profile['channels_last']}")
+
+oversubscription = check_oversubscription(MAX_INFLIGHT_INFERENCES)
+if oversubscription:
+    logger.warning(oversubscription)
+load_monitor = LoadMonitor()
+
 # ----------------------------
 # Image Transform
 # ----------------------------
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406],
-                         [0.229, 0.224, 0.225]),
-])
+# Test-time augmentation: "none", "flip", "five_crop" or "five_crop_flip".
+# Callers can override it per request; all views run as a single batch.
+TTA_MODE = "none"
+pipeline.tta_mode = TTA_MODE
+
+# ----------------------------
+# Face Embedding Index
+# ----------------------------
+# Optional: keep the 1280-d backbone embedding of every prediction so repeated and
+# near-duplicate faces reuse a known verdict, and reviewers can look up similar cases.
+# One index per checkpoint; a verdict is only reused under the TTA mode and calibration it was made with.
+EMBEDDINGS_ENABLED = False
+INDEX_DIR = "face_index"
+DUPLICATE_SIMILARITY = 0.98   # cosine similarity above which a stored verdict is reused
+
+face_index = VectorIndex(os.path.join(INDEX_DIR, MODEL_VERSION), MODEL_CHECKSUM) if EMBEDDINGS_ENABLED else None
+
+# ----------------------------
+# Prediction Log
+# ----------------------------
+# Every prediction is queued for a background SQLite (WAL) writer; see GET /predictions
+PREDICTION_LOG_ENABLED = True
+PREDICTION_LOG_DIR = "prediction_logs"
+
+prediction_log = PredictionLog(PREDICTION_LOG_DIR) if PREDICTION_LOG_ENABLED else None
 
 # ----------------------------
-# Face Detection Setup
+# Request Profiler
 # ----------------------------
-# Load OpenCV Haar Cascade for face detection
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+# Started via POST /admin/profile; costs one attribute check per call while idle.
+# Admin endpoints need the X-Admin-Token header when ADMIN_TOKEN is set, else a local client.
+PROFILE_DIR = "profiles"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 
-def detect_face(pil_image):
-    """Detects if a human face is present in the image."""
-    cv_img = np.array(pil_image.convert("RGB"))[:, :, ::-1]  # Convert to OpenCV BGR
-    gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
-    return len(faces) > 0
+profiler = RequestProfiler(PROFILE_DIR)
 
 # ----------------------------
 # Prediction Function
 # ----------------------------
-def predict_image(image):
+def embed_image(image):
+    """Backbone embedding of the plain (non-augmented) view: (logits, embedding)."""
+    logits, embedding = pipeline.infer_with_embeddings(pipeline.preprocess([image], "none"), "none")
+    return logits, embedding[0].cpu().numpy()
+
+@profiler.profile_call
+def predict_image(image, tta_mode=TTA_MODE, content_key=None):
+    """
+    Returns (label, confidence, details); details holds per-stage timings and,
+    with the embedding index enabled, the embedding and any duplicate match.
+    """
     try:
+        timings = {}
+        details = {"timings": timings}
+
         # Check if a face is detected first
-        if not detect_face(image):
+        start = time.perf_counter()
+        with profiler.stage("detect_face"):
+            has_face = pipeline.detect([image])[0]
+        timings["detect_ms"] = (time.perf_counter() - start) * 1000
+        if not has_face:
             logger.warning("No face detected in image")
-            return "no_face_detected", 0.0
+            return NO_FACE, 0.0, details
 
-        # Transform and predict
-        img_tensor = transform(image).unsqueeze(0).to(device)
-        with torch.no_grad():
-            outputs = model(img_tensor)
-            probabilities = torch.nn.functional.softmax(outputs, dim=1)
-            _, predicted = torch.max(outputs, 1)
+        start = time.perf_counter()
+        if face_index is None:
+            # Transform and predict
+            with profiler.stage("transform"):
+                img_tensor = pipeline.preprocess([image], tta_mode)
+            with profiler.stage("forward"):
+                logits = pipeline.infer(img_tensor, tta_mode)
+        else:
+            # The plain view gives both logits and embedding; a near-duplicate with a
+            # known verdict skips the remaining TTA views
+            with profiler.stage("embed"):
+                logits, embedding = embed_image(image)
+            details["embedding"] = embedding
+            match = face_index.nearest_duplicate(embedding, DUPLICATE_SIMILARITY, pipeline.decision_key(tta_mode))
+            if match is not None:
+                logger.info(f"Near-duplicate of {match['key']} (similarity {match['similarity']:.4f})")
+                details["duplicate_of"] = match
+                timings["infer_ms"] = (time.perf_counter() - start) * 1000
+                return match["label"], match["confidence"], details
+            if tta_mode != "none":
+                with profiler.stage("transform"):
+                    img_tensor = pipeline.preprocess([image], tta_mode)
+                with profiler.stage("forward"):
+                    logits = pipeline.infer(img_tensor, tta_mode)
 
-        confidence = probabilities[0][predicted.item()].item()
+        # Temperature scaling and the threshold on P(drug_user) calibrated for this TTA mode
+        label, confidence = pipeline.postprocess(logits, tta_mode)[0]
+        timings["infer_ms"] = (time.perf_counter() - start) * 1000
 
-        label = "drug_user" if predicted.item() == 0 else "not_user"
+        if face_index is not None:
+            face_index.add(embedding, [LABELS.index(label)], [confidence], [content_key or ""],
+                           [pipeline.decision_key(tta_mode)])
 
         logger.info(f"Prediction: {label}, Confidence: {confidence:.4f}")
-        return label, confidence
+        return label, confidence, details
 
     except Exception as e:
         logger.error(f"Error during prediction: {e}")
         raise
 
+# ----------------------------
+# Admitted Inference
+# ----------------------------
+def open_base64_image(image_data):
+    """Decodes a base64 payload and sniffs its header without decoding pixels: (bytes, image)."""
+    if len(image_data) * 3 // 4 > MAX_UPLOAD_BYTES:
+        raise AdmissionRejected(413, f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+    image_bytes = base64.b64decode(image_data)
+    return image_bytes, sniff_image(image_bytes, MAX_DECODED_PIXELS)
+
+def parse_tta_mode(value):
+    if not value:
+        return TTA_MODE
+    if value not in TTA_MODES:
+        raise AdmissionRejected(400, f"Unknown TTA mode {value!r}, expected one of {list(TTA_MODES)}")
+    return value
+
+@profiler.profile_call
+def decode_and_predict(image, tta_mode, content_key=None):
+    # An upload seen before (same bytes) reuses its stored verdict without decoding
+    if face_index is not None and content_key:
+        match = face_index.lookup_key(content_key, pipeline.decision_key(tta_mode))
+        if match is not None:
+            logger.info(f"Exact duplicate of {content_key}")
+            return match["label"], match["confidence"], {"duplicate_of": dict(match, similarity=1.0)}
+
+    start = time.perf_counter()
+    with profiler.stage("decode"):
+        image = pipeline.decode([image])[0]
+    decode_ms = (time.perf_counter() - start) * 1000
+
+    label, confidence, details = predict_image(image, tta_mode, content_key)
+    details["timings"]["decode_ms"] = decode_ms
+    return label, confidence, details
+
+def decode_and_embed(image):
+    image = pipeline.decode([image])[0]
+    if not pipeline.detect([image])[0]:
+        return None
+    return embed_image(image)[1]
+
+def build_details(details, return_embedding):
+    extra = {}
+    if "duplicate_of" in details:
+        extra["duplicate_of"] = details["duplicate_of"]
+    if return_embedding and "embedding" in details:
+        extra["embedding"] = np.round(details["embedding"], 5).tolist()
+    return extra
+
+def parse_flag(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+def client_address(connection):
+    """Peer address for the per-client cap; never a caller-supplied id, which could change per request."""
+    return connection.client.host if connection.client else "unknown"
+
+async def run_admitted(priority, deadline, func, *args, timings=None):
+    """Waits for an inference slot and runs ``func`` off the event loop."""
+    load_monitor.maybe_warn()
+    start = time.perf_counter()
+    async with scheduler.slot(priority, deadline):
+        if timings is not None:
+            timings["queue_ms"] = (time.perf_counter() - start) * 1000
+        deadline.check("inference")
+        return await run_in_threadpool(func, *args)
+
+def log_prediction(content_key, label, confidence, tta_mode, details, timings, started):
+    """Queues the prediction for the background log writer; never blocks."""
+    if prediction_log is None:
+        return
+    timings.update(details.get("timings", {}))
+    prediction_log.record(
+        content_hash=content_key,
+        label=label,
+        confidence=confidence,
+        model_version=MODEL_VERSION,
+        tta_mode=tta_mode,
+        total_ms=(time.perf_counter() - started) * 1000,
+        **timings,
+    )
+
 # ----------------------------
 # FastAPI Setup
 # ----------------------------
@@ -112,20 +285,27 @@ app.add_middleware(
 # POST Endpoint for File Upload
 # ----------------------------
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+@profiler.profile_endpoint
+async def upload_file(request: Request):
+    started = time.perf_counter()
     try:
-        logger.info(f"Received file: {file.filename}")
-        
-        # Read the uploaded file
-        contents = await file.read()
-        
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
-        
-        # Predict
-        label, confidence = predict_image(image)
+        deadline = Deadline.from_value(request.headers.get("X-Request-Deadline-Ms"),
+                                       DEFAULT_DEADLINE_MS, MAX_DEADLINE_MS)
+        priority = parse_priority(request.headers.get("X-Priority"))
+        tta_mode = parse_tta_mode(request.headers.get("X-TTA-Mode"))
+        async with client_limiter.hold(client_address(request)):
+            # Stream the upload against the byte limit; type and dimensions are checked from the header
+            filename, contents, image = await read_upload(request, MAX_UPLOAD_BYTES, MAX_DECODED_PIXELS)
+            logger.info(f"Received file: {filename}")
+            content_key = hashlib.sha256(contents).hexdigest()
+
+            # Predict
+            timings = {}
+            label, confidence, details = await run_admitted(priority, deadline, decode_and_predict,
+                                                            image, tta_mode, content_key, timings=timings)
+            log_prediction(content_key, label, confidence, tta_mode, details, timings, started)
         
-        if label == "no_face_detected":
+        if label == NO_FACE:
             return {
                 "result": "No face detected",
                 "confidence": 0.0,
@@ -138,9 +318,13 @@ async def upload_file(file: UploadFile = File(...)):
             return {
                 "result": readable_result,
                 "confidence": confidence,
-                "prediction": label
+                "prediction": label,
+                **build_details(details, parse_flag(request.headers.get("X-Return-Embedding"))),
             }
             
+    except AdmissionRejected as e:
+        logger.warning(f"Request rejected ({e.status_code}): {e.reason}")
+        raise HTTPException(status_code=e.status_code, detail=e.reason)
     except Exception as e:
         logger.error(f"Error processing upload: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
@@ -148,10 +332,64 @@ async def upload_file(file: UploadFile = File(...)):
 # ----------------------------
 # WebSocket Endpoint
 # ----------------------------
+@profiler.profile_endpoint
+async def websocket_message(data, client_id):
+    """Handles one message of a /ws connection and returns the response; profiled per message."""
+    try:
+        started = time.perf_counter()
+        message = json.loads(data)
+
+        if "image" in message:
+            image_data = message["image"]
+        elif "data" in message:
+            image_data = message["data"]
+        else:
+            return {"error": "No image data found"}
+
+        deadline = Deadline.from_value(message.get("deadline_ms"), DEFAULT_DEADLINE_MS, MAX_DEADLINE_MS)
+        priority = parse_priority(message.get("priority"))
+        tta_mode = parse_tta_mode(message.get("tta"))
+
+        async with client_limiter.hold(client_id):
+            # Decode payload and sniff the image header
+            image_bytes, image = open_base64_image(image_data)
+            content_key = hashlib.sha256(image_bytes).hexdigest()
+
+            # Predict or detect face
+            timings = {}
+            label, confidence, details = await run_admitted(priority, deadline, decode_and_predict,
+                                                            image, tta_mode, content_key, timings=timings)
+            log_prediction(content_key, label, confidence, tta_mode, details, timings, started)
+
+        if label == NO_FACE:
+            response = {"error": "No face detected in the image"}
+        else:
+            response = {
+                "prediction": label,
+                "confidence": round(confidence, 4),
+                **build_details(details, False),
+            }
+
+        logger.info(f"Response sent: {response}")
+        if "embedding" in details and parse_flag(message.get("return_embedding")):
+            # Added after logging to keep the log line short
+            response["embedding"] = np.round(details["embedding"], 5).tolist()
+        return response
+
+    except json.JSONDecodeError:
+        return {"error": "Invalid JSON"}
+    except AdmissionRejected as e:
+        logger.warning(f"Request rejected ({e.status_code}): {e.reason}")
+        return {"error": e.reason, "status": e.status_code}
+    except Exception as e:
+        logger.error(f"Error processing request: {e}")
+        return {"error": str(e)}
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     logger.info("Client connected")
+    client_id = client_address(websocket)
 
     try:
         while True:
@@ -161,49 +399,103 @@ async def websocket_endpoint(websocket: WebSocket):
                 logger.info("Client disconnected")
                 break
 
-            try:
-                message = json.loads(data)
-
-                if "image" in message:
-                    image_data = message["image"]
-                elif "data" in message:
-                    image_data = message["data"]
-                else:
-                    await websocket.send_text(json.dumps({"error": "No image data found"}))
-                    continue
-
-                # Decode image
-                image_bytes = base64.b64decode(image_data)
-                image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-
-                # Predict or detect face
-                label, confidence = predict_image(image)
-
-                if label == "no_face_detected":
-                    response = {"error": "No face detected in the image"}
-                else:
-                    response = {
-                        "prediction": label,
-                        "confidence": round(confidence, 4)
-                    }
-
-                await websocket.send_text(json.dumps(response))
-                logger.info(f"Response sent: {response}")
-
-            except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({"error": "Invalid JSON"}))
-            except Exception as e:
-                logger.error(f"Error processing request: {e}")
-                await websocket.send_text(json.dumps({"error": str(e)}))
+            # The connection lives for many predictions, so each message is timed, not the connection
+            response = await websocket_message(data, client_id)
+            await websocket.send_text(json.dumps(response))
 
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
         logger.info("WebSocket connection closed")
 
+# ----------------------------
+# Similar Case Lookup
+# ----------------------------
+@app.post("/similar")
+@profiler.profile_endpoint
+async def similar_cases(request: Request, k: int = 5):
+    if face_index is None:
+        raise HTTPException(status_code=404, detail="Embedding index is disabled (EMBEDDINGS_ENABLED)")
+    try:
+        deadline = Deadline.from_value(request.headers.get("X-Request-Deadline-Ms"),
+                                       DEFAULT_DEADLINE_MS, MAX_DEADLINE_MS)
+        priority = parse_priority(request.headers.get("X-Priority"))
+        async with client_limiter.hold(client_address(request)):
+            _, _, image = await read_upload(request, MAX_UPLOAD_BYTES, MAX_DECODED_PIXELS)
+            embedding = await run_admitted(priority, deadline, decode_and_embed, image)
+
+        if embedding is None:
+            return {"error": "No face detected in the image. Please upload a clear face image."}
+        matches = await run_in_threadpool(face_index.similar, embedding, max(1, min(k, 100)))
+        return {"similar": matches}
+
+    except AdmissionRejected as e:
+        logger.warning(f"Request rejected ({e.status_code}): {e.reason}")
+        raise HTTPException(status_code=e.status_code, detail=e.reason)
+    except Exception as e:
+        logger.error(f"Error processing similarity lookup: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
+# ----------------------------
+# Prediction Log Query
+# ----------------------------
+@app.get("/predictions")
+async def list_predictions(start: float = None, end: float = None, label: str = None,
+                           min_confidence: float = None, max_confidence: float = None, limit: int = 100):
+    """Newest-first logged predictions; start/end are Unix timestamps."""
+    if prediction_log is None:
+        raise HTTPException(status_code=404, detail="Prediction log is disabled (PREDICTION_LOG_ENABLED)")
+    rows = await run_in_threadpool(prediction_log.query, start, end, label,
+                                   min_confidence, max_confidence, max(1, min(limit, 1000)))
+    return {"count": len(rows), "predictions": rows}
+
+# ----------------------------
+# Profiling Endpoints
+# ----------------------------
+def check_admin(request):
+    if ADMIN_TOKEN:
+        if request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+            raise HTTPException(status_code=403, detail="Invalid admin token")
+    elif not request.client or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403, detail="Admin endpoints are local-only unless ADMIN_TOKEN is set")
+
+@app.post("/admin/profile")
+async def start_profiling(request: Request, requests: int = 20, seconds: float = 60.0):
+    """Profiles the next ``requests`` predictions or ``seconds`` seconds, whichever ends first."""
+    check_admin(request)
+    try:
+        session_dir = profiler.start(max(requests, 1), max(seconds, 1.0))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"profiling": True, "session_dir": session_dir}
+
+@app.get("/admin/profile")
+async def profiling_summary(request: Request, top: int = 20):
+    check_admin(request)
+    return profiler.summary(top)
+
+@app.delete("/admin/profile")
+async def stop_profiling(request: Request):
+    check_admin(request)
+    await run_in_threadpool(profiler.stop)
+    return profiler.summary()
+
+@app.on_event("shutdown")
+def flush_on_shutdown():
+    if face_index is not None:
+        face_index.flush()
+    if prediction_log is not None:
+        prediction_log.close()
+
 # ----------------------------
 # Health Check Endpoint
 # ----------------------------
 @app.get("/")
 async def health_check():
-    return {"status": "healthy", "model_loaded": True}
\ No newline at end of file
+    return {
+        "status": "healthy",
+        "model_loaded": True,
+        "admission": scheduler.stats(),
+        "indexed_faces": len(face_index) if face_index is not None else None,
+        "prediction_log": prediction_log.stats() if prediction_log is not None else None,
+    }
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Synthetic ImageFolder datasets of any size, derived from a small labelled set.
+
+    python synthetic_data.py --source drug_users_test --output synthetic/n100000 --count 100000
+
+Every output image is a bundled image put through a random flip, rotation,
+crop, resize and brightness/contrast change. Classes are interleaved in
+proportion to the source, so class folders and class proportions match the
+source at any ``--count``. Images are seeded by their index, so the same
+arguments always give the same dataset and an interrupted run resumes where
+it stopped. A run with another source, seed, resolutions, formats or quality
+refuses a directory generated with different settings unless ``--overwrite``
+clears it; changing only ``--count`` grows or trims the dataset. Files are
+spread over sub-folders of ``SHARD_SIZE`` images (ImageFolder walks them
+recursively) to keep directories listable at 1M.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+from collections import Counter
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+FORMATS = {"png": ("PNG", ".png"), "jpeg": ("JPEG", ".jpg")}
+SHARD_SIZE = 10000
+CHUNK_SIZE = 500
+MANIFEST = "synthetic.json"
+LAYOUT_VERSION = 2      # bump when the index -> source image mapping changes
+PNG_COMPRESS_LEVEL = 1  # zlib's default (6) makes PNG encoding ~3x slower than the augmentation for ~15% smaller files
+
+_source_cache = {}
+
+
+# ----------------------------
+# Source Images
+# ----------------------------
+def list_sources(source_dir):
+    """[(path, class_name)] for every image in an ImageFolder-style directory, in a stable order."""
+    sources = []
+    for class_name in sorted(os.listdir(source_dir)):
+        class_dir = os.path.join(source_dir, class_name)
+        if not os.path.isdir(class_dir):
+            continue
+        for root, _, files in sorted(os.walk(class_dir)):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    sources.append((os.path.join(root, name), class_name))
+    if not sources:
+        raise ValueError(f"No images found under {source_dir}")
+    return sources
+
+
+def interleave_classes(sources):
+    """
+    Reorders ``sources`` so classes alternate in proportion to their sizes:
+    each position takes the class furthest behind its share, so every prefix
+    of the generated dataset (any ``count``) keeps the source class balance.
+    """
+    by_class = {}
+    for source in sources:
+        by_class.setdefault(source[1], []).append(source)
+    total = len(sources)
+    taken = dict.fromkeys(by_class, 0)
+    order = []
+    for position in range(1, total + 1):
+        class_name = max(by_class, key=lambda c: position * len(by_class[c]) / total - taken[c])
+        order.append(by_class[class_name][taken[class_name]])
+        taken[class_name] += 1
+    return order
+
+
+def _load_source(path):
+    # Per worker process; the bundled sets are small enough to keep decoded
+    if path not in _source_cache:
+        with Image.open(path) as image:
+            _source_cache[path] = image.convert("RGB")
+    return _source_cache[path]
+
+
+# ----------------------------
+# Augmentation
+# ----------------------------
+def augment(image, rng, size):
+    """Random flip, rotation, crop (80-100% of each side), resize to size x size and colour jitter."""
+    if rng.random() < 0.5:
+        image = image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    image = image.rotate(rng.uniform(-15, 15), resample=Image.Resampling.BILINEAR)
+
+    width, height = image.size
+    crop_w, crop_h = int(width * rng.uniform(0.8, 1.0)), int(height * rng.uniform(0.8, 1.0))
+    left, top = rng.integers(0, width - crop_w + 1), rng.integers(0, height - crop_h + 1)
+    image = image.resize((size, size), Image.Resampling.BILINEAR, box=(left, top, left + crop_w, top + crop_h))
+
+    image = ImageEnhance.Brightness(image).enhance(rng.uniform(0.8, 1.2))
+    return ImageEnhance.Contrast(image).enhance(rng.uniform(0.8, 1.2))
+
+
+def output_path(output_dir, class_name, index, fmt):
+    return os.path.join(output_dir, class_name, f"{index // SHARD_SIZE:04d}", f"{index:07d}{FORMATS[fmt][1]}")
+
+
+def _generate_chunk(job):
+    sources, output_dir, indices, resolutions, formats, seed, jpeg_quality = job
+    written = 0
+    for index in indices:
+        rng = np.random.default_rng([seed, index])
+        path, class_name = sources[index % len(sources)]
+        size = resolutions[rng.integers(len(resolutions))]
+        fmt = formats[rng.integers(len(formats))]
+        target = output_path(output_dir, class_name, index, fmt)
+        if os.path.exists(target):
+            continue  # resuming an interrupted run
+        image = augment(_load_source(path), rng, size)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Write-then-rename so an interrupted run never leaves a truncated image behind
+        tmp = target + ".tmp"
+        options = {"quality": jpeg_quality} if fmt == "jpeg" else {"compress_level": PNG_COMPRESS_LEVEL}
+        image.save(tmp, FORMATS[fmt][0], **options)
+        os.replace(tmp, target)
+        written += 1
+    return len(indices), written
+
+
+# ----------------------------
+# Dataset Generation
+# ----------------------------
+def _check_output_dir(output_dir, config, overwrite):
+    """
+    Makes ``output_dir`` safe to (re)generate into with ``config``. Images are
+    only reused when the manifest says they were made with the same settings;
+    the manifest is written before generating, so this also covers runs that
+    were interrupted.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            existing = json.load(f)
+        if {k: existing.get(k) for k in config} == config:
+            return existing
+        reason = f"it was generated with different settings ({manifest_path})"
+    elif os.path.isdir(output_dir) and next(_scan_files(output_dir), None) is not None:
+        reason = f"it holds images without a {MANIFEST} manifest"
+    else:
+        return None
+    if not overwrite:
+        raise ValueError(f"Refusing to generate into {output_dir}: {reason}. Use another directory or overwrite it (--overwrite).")
+    shutil.rmtree(output_dir)
+    return None
+
+
+def _trim(output_dir, count):
+    """Deletes images with an index >= ``count`` and temporary files left by an interrupted run."""
+    for root, _, files in os.walk(output_dir):
+        for name in files:
+            stem = name.split(".", 1)[0]
+            if name.endswith(".tmp") or (name.lower().endswith(IMAGE_EXTENSIONS) and stem.isdigit() and int(stem) >= count):
+                os.remove(os.path.join(root, name))
+
+
+def generate_dataset(source_dir, output_dir, count, resolutions=(224,), formats=("png",), seed=0,
+                     jpeg_quality=90, workers=None, overwrite=False):
+    """
+    Writes ``count`` augmented images to ``output_dir`` and returns the
+    manifest. Raises ``ValueError`` if the directory holds images made with
+    other settings, unless ``overwrite`` clears it first.
+    """
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    config = {
+        "layout": LAYOUT_VERSION,
+        "source": os.path.abspath(source_dir),
+        "resolutions": list(resolutions),
+        "formats": list(formats),
+        "seed": seed,
+        "jpeg_quality": jpeg_quality,
+    }
+    manifest = dict(config, count=count)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    existing = _check_output_dir(output_dir, config, overwrite)
+    if existing is not None and existing.get("count") == count and existing.get("complete"):
+        return existing
+
+    # Provisional manifest: a later run only resumes into this directory with the same settings
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(dict(manifest, complete=False), f, indent=2)
+    _trim(output_dir, count)
+
+    sources = interleave_classes(list_sources(source_dir))
+    jobs = [(sources, output_dir, range(start, min(start + CHUNK_SIZE, count)), list(resolutions), list(formats),
+             seed, jpeg_quality) for start in range(0, count, CHUNK_SIZE)]
+    done = written = 0
+    with multiprocessing.get_context("spawn").Pool(workers or os.cpu_count()) as pool:
+        for chunk_done, chunk_written in pool.imap_unordered(_generate_chunk, jobs):
+            done += chunk_done
+            written += chunk_written
+            print(f"\r  {done}/{count} images ({written} new)", end="", flush=True)
+    print()
+
+    manifest["classes"] = dict(sorted(Counter(sources[i % len(sources)][1] for i in range(count)).items()))
+    manifest["bytes"] = sum(entry.stat().st_size for entry in _scan_files(output_dir))
+    manifest["complete"] = True
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _scan_files(directory):
+    for entry in os.scandir(directory):
+        if entry.is_dir():
+            yield from _scan_files(entry.path)
+        elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+            yield entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default="drug_users_test")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--count", type=int, required=True)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[224], help="output sides, picked per image")
+    parser.add_argument("--formats", nargs="+", default=["png"], choices=list(FORMATS), help="picked per image")
+    parser.add_argument("--jpeg-quality", type=int, default=90)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--overwrite", action="store_true", help="clear an output directory made with other settings")
+    args = parser.parse_args()
+
+    manifest = generate_dataset(args.source, args.output, args.count, args.resolutions, args.formats,
+                                args.seed, args.jpeg_quality, args.workers, args.overwrite)
+    print(f"✅ {manifest['count']} images ({manifest['bytes'] / 1e9:.2f} GB) in {args.output}: {manifest['classes']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+from cpu_tuning import run_sweep
+
+
+def test_sweep_runs_each_interop_value_in_a_fresh_process():
+    # set_num_interop_threads raises if called twice in one process
+    jobs = [(interop, [1], [1], 1, None, 0.05) for interop in (1, 2)]
+    results = run_sweep(jobs)
+    assert sorted({r["torch_interop_threads"] for r in results}) == [1, 2]
+    assert all(r["throughput"] > 0 for r in results)
@@ -0,0 +1,42 @@
+import glob
+import os
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+from inference import Pipeline, build_model
+from request_profiler import RequestProfiler
+
+
+def test_concurrent_predictions_are_traced_one_at_a_time(tmp_path):
+    pipeline = Pipeline(device=torch.device("cpu"), detect_faces=False)
+    pipeline.model = build_model().eval()
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (240, 240, 3), dtype=np.uint8))
+
+    profiler = RequestProfiler(str(tmp_path))
+    both_running = threading.Barrier(2)
+
+    @profiler.profile_call
+    def predict(item):
+        # Both calls are inside the profiled wrapper before either runs the model
+        both_running.wait(timeout=30)
+        with profiler.stage("forward"):
+            return pipeline.predict([item])
+
+    session_dir = profiler.start(requests=2, seconds=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(predict(image))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    assert len(results) == 2 and results[0] == results[1]
+    assert not profiler.active   # two predictions end the session
+    summary = profiler.summary()
+    assert summary["predictions"] == 2
+    assert summary["untraced_predictions"] == 1
+    assert len(glob.glob(os.path.join(session_dir, "trace-*.json"))) == 1
+    assert os.path.exists(os.path.join(session_dir, "stacks.folded"))